@@ -14,7 +14,13 @@ def build_manifest_file_content(records):
     data_file_list = [
         {
             'bucketName': r['s3']['bucket']['name'],
-            'objectKey': r['s3']['object']['key']
+            'objectKey': r['s3']['object']['key'],
+            # Object identity lets preprocessing reuse data it has already parsed
+            **{
+                field: r['s3']['object'][field]
+                for field in ('eTag', 'versionId', 'size')
+                if field in r['s3']['object']
+            }
         }
         for r in records if 's3' in r
     ]
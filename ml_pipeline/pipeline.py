@@ -44,6 +44,7 @@ from sagemaker.sklearn import SKLearnModel
 from sagemaker.sklearn.processing import SKLearnProcessor
 from sagemaker.workflow.functions import Join
 from sagemaker.workflow.conditions import ConditionLessThanOrEqualTo
+from sagemaker.workflow.execution_variables import ExecutionVariables
 from sagemaker.workflow.condition_step import (
     ConditionStep,
     JsonGet,
@@ -64,6 +65,20 @@ from sagemaker.workflow.step_collections import RegisterModel
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# content types the XGBoost container reads each preprocessing output format with
+training_content_types = {
+    "csv": "text/csv",
+    "parquet": "application/x-parquet",
+    "recordio": "application/x-recordio-protobuf",
+}
+
+# content types transform.py can hand the transformed features to the XGBoost container in
+inference_content_types = {
+    "csv": "text/csv",
+    "libsvm": "text/libsvm",
+    "recordio": "application/x-recordio-protobuf",
+}
+
 def get_session(region, default_bucket):
     """Gets the sagemaker session based on the region.
 
@@ -93,6 +108,8 @@ def get_pipeline(
     model_package_group_name="AbaloneModelPackageGroup",
     pipeline_name="AbalonePipeline",
     base_job_prefix="Abalone",
+    output_format="recordio",
+    inference_format="recordio",
 ):
     """Gets a SageMaker ML Pipeline instance working with on abalone data.
 
@@ -100,6 +117,10 @@ def get_pipeline(
         region: AWS region to create and run the pipeline.
         role: IAM role to create and run steps and pipeline.
         default_bucket: the bucket to use for storing the artifacts
+        output_format: the format of the train and validation datasets, one of
+            training_content_types; the test dataset is always written as .npy
+        inference_format: the format the preprocessing container of the inference
+            pipeline responds in to the XGBoost container, one of inference_content_types
 
     Returns:
         an instance of a pipeline
@@ -119,6 +140,21 @@ def get_pipeline(
     model_approval_status = ParameterString(
         name="ModelApprovalStatus", default_value="Approved"
     )
+    download_concurrency = ParameterInteger(name="DownloadConcurrency", default_value=8)
+    transform_workers = ParameterInteger(name="TransformWorkers", default_value=2)
+    training_instance_count = ParameterInteger(name="TrainingInstanceCount", default_value=1)
+    split_shards = ParameterInteger(name="SplitShards", default_value=8)
+    # a fraction such as 0.1, sampled uniformly, or a row count such as 10000, stratified by
+    # rings and split across the processing instances; --sample-stratify only applies to a count
+    sample_size = ParameterString(name="SampleSize", default_value="all")
+    # the deduplication index to drop rows already ingested from other objects with, such as
+    # s3://<bucket>/<prefix>/statistics/dedup-index.npz; single-host processing only, so off
+    # by default
+    dedup_index_uri = ParameterString(name="DedupIndexUri", default_value="")
+    # the prefix to checkpoint the preprocessing stages under, such as
+    # s3://<bucket>/<prefix>/checkpoints, so that a retried job resumes where it failed; a run
+    # removes its checkpoint once it succeeds, so off by default to save the extra writes
+    checkpoint_uri = ParameterString(name="CheckpointUri", default_value="")
 
     # processing step for feature engineering
     sklearn_processor = SKLearnProcessor(
@@ -130,22 +166,73 @@ def get_pipeline(
         role=role,
     )
 
-    f = open(os.path.join(BASE_DIR, "..", "dataManifest.json"))
+    # the manifest is shipped as a processing input rather than a job argument
+    # so that its size is not bounded by the command line
     step_process = ProcessingStep(
         name="PreprocessData",
         processor=sklearn_processor,
+        inputs=[
+            ProcessingInput(
+                source=os.path.join(BASE_DIR, "..", "dataManifest.json"),
+                destination="/opt/ml/processing/manifest",
+            ),
+        ],
         outputs=[
             ProcessingOutput(output_name="train", source="/opt/ml/processing/train"),
             ProcessingOutput(output_name="validation", source="/opt/ml/processing/validation"),
             ProcessingOutput(output_name="test", source="/opt/ml/processing/test"),
             ProcessingOutput(output_name="model", source="/opt/ml/processing/model"),
+            ProcessingOutput(output_name="index", source="/opt/ml/processing/index"),
+            ProcessingOutput(output_name="profile", source="/opt/ml/processing/profile"),
         ],
         code=os.path.join(BASE_DIR, "..", "src", "preprocess.py"),
-        job_arguments=["--data-manifest", f.read()],
+        job_arguments=[
+            "--data-manifest-file",
+            "/opt/ml/processing/manifest/dataManifest.json",
+            "--download-concurrency",
+            download_concurrency.to_string(),
+            "--transform-workers",
+            transform_workers.to_string(),
+            "--multipart-threshold",
+            str(64 * 1024 * 1024),
+            "--chunked",
+            "--statistics-uri",
+            f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/statistics/statistics.json",
+            # saved per-source medians are sketched rather than kept as exact value counts,
+            # which grow with the distinct values of every source
+            "--median-rank-error",
+            "0.001",
+            "--dedup-index",
+            dedup_index_uri,
+            "--split-mode",
+            "hash",
+            "--split-seed",
+            "42",
+            "--rendezvous-uri",
+            Join(
+                on="/",
+                values=[
+                    f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/rendezvous",
+                    ExecutionVariables.PIPELINE_EXECUTION_ID,
+                ],
+            ),
+            "--shards",
+            split_shards.to_string(),
+            "--data-profile",
+            "--sample",
+            sample_size,
+            "--sample-seed",
+            "42",
+            "--sample-stratify",
+            "--output-format",
+            output_format,
+            "--test-format",
+            "npy",
+            "--checkpoint-uri",
+            checkpoint_uri,
+        ],
     )
 
-    f.close()
-
     # training step for generating model artifacts
     model_path = f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/Train"
     image_uri = sagemaker.image_uris.retrieve(
@@ -158,7 +245,7 @@ def get_pipeline(
     xgb_train = Estimator(
         image_uri=image_uri,
         instance_type=training_instance_type,
-        instance_count=1,
+        instance_count=training_instance_count,
         output_path=model_path,
         base_job_name=f"{base_job_prefix}/train",
         sagemaker_session=sagemaker_session,
@@ -182,13 +269,15 @@ def get_pipeline(
                 s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
                     "train"
                 ].S3Output.S3Uri,
-                content_type="text/csv",
+                content_type=training_content_types[output_format],
+                # every training instance gets its own subset of the train shards
+                distribution="ShardedByS3Key",
             ),
             "validation": TrainingInput(
                 s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
                     "validation"
                 ].S3Output.S3Uri,
-                content_type="text/csv",
+                content_type=training_content_types[output_format],
             ),
         },
     )
@@ -222,6 +311,12 @@ def get_pipeline(
                 ].S3Output.S3Uri,
                 destination="/opt/ml/processing/test",
             ),
+            ProcessingInput(
+                source=step_process.properties.ProcessingOutputConfig.Outputs[
+                    "index"
+                ].S3Output.S3Uri,
+                destination="/opt/ml/processing/index",
+            ),
         ],
         outputs=[
             ProcessingOutput(output_name="evaluation", source="/opt/ml/processing/evaluation"),
@@ -247,6 +342,8 @@ def get_pipeline(
         framework_version="1.2-1",
         py_version="py3",
         sagemaker_session=sagemaker_session,
+        # The accept transform.py encodes its response to the XGBoost container with.
+        env={"SAGEMAKER_DEFAULT_INVOCATIONS_ACCEPT": inference_content_types[inference_format]},
         model_data=Join(on='/', values=[step_process.properties.ProcessingOutputConfig.Outputs[
                     "model"
                 ].S3Output.S3Uri, "model.tar.gz"]),
@@ -308,7 +405,14 @@ def get_pipeline(
             processing_instance_type,
             processing_instance_count,
             training_instance_type,
-            model_approval_status
+            model_approval_status,
+            download_concurrency,
+            transform_workers,
+            training_instance_count,
+            split_shards,
+            sample_size,
+            dedup_index_uri,
+            checkpoint_uri,
         ],
         steps=[step_process, step_train, step_eval, step_cond],
         sagemaker_session=sagemaker_session,
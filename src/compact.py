@@ -0,0 +1,235 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                                                              *
+
+"""Compacts the small objects of the data manifest into large Parquet files."""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import zipfile
+
+import boto3
+from botocore.exceptions import ClientError
+
+from preprocess import DataBuilder, concat_frames, read_uri, write_uri
+
+# Input bytes merged into one compacted file, by default.
+default_target_bytes = 128 * 1024 * 1024
+
+def read_manifest(uri, s3_client=None):
+    """Reads a manifest, plain JSON or zipped as manifest.json.
+
+    Returns it and the version it was read at: the ETag of an S3 manifest,
+    or the bytes of a local one.
+    """
+    data = version = None
+    if uri.startswith("s3://"):
+        bucket, key = uri[len("s3://"):].split("/", 1)
+        try:
+            response = (s3_client or boto3.client("s3")).get_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+        else:
+            data, version = response["Body"].read(), response["ETag"]
+    else:
+        data = version = read_uri(uri)
+    if data is None:
+        raise ValueError(f"No manifest found at {uri}")
+    text = zipfile.ZipFile(io.BytesIO(data)).read("manifest.json") if uri.endswith(".zip") else data
+    return json.loads(text), version
+
+def write_manifest(uri, manifest, version, s3_client=None):
+    """Writes manifest over the version of it read by read_manifest, if it is still that version.
+
+    An S3 manifest is put conditionally on its ETag, so a concurrent write is
+    never lost. A local one is compared to the version just before it is
+    written over.
+    """
+    data = encode_manifest(uri, manifest)
+    if not uri.startswith("s3://"):
+        if read_uri(uri) != version:
+            raise RuntimeError(f"The manifest {uri} changed while it was compacted")
+        write_uri(uri, data)
+        return
+    bucket, key = uri[len("s3://"):].split("/", 1)
+    try:
+        (s3_client or boto3.client("s3")).put_object(
+            Bucket=bucket, Key=key, Body=data, IfMatch=version
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict"):
+            raise RuntimeError(f"The manifest {uri} changed while it was compacted") from e
+        raise
+
+def encode_manifest(uri, manifest):
+    text = json.dumps(manifest).encode()
+    if not uri.endswith(".zip"):
+        return text
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("manifest.json", text)
+    return buffer.getvalue()
+
+def plan_groups(entries, target_bytes, small_bytes):
+    """Groups runs of consecutive small entries of up to target_bytes in all.
+
+    An entry is small if its "size" is below small_bytes. Any other entry,
+    including prefix entries and entries without a size, is a group of its
+    own, so that the manifest order is kept.
+    """
+    groups, group, group_bytes = [], [], 0
+    for entry in entries:
+        size = entry.get("size")
+        small = "objectKey" in entry and size is not None and size < small_bytes
+        if group and (not small or group_bytes + size > target_bytes):
+            groups.append(group)
+            group, group_bytes = [], 0
+        if small:
+            group.append(entry)
+            group_bytes += size
+        else:
+            groups.append([entry])
+    if group:
+        groups.append(group)
+    return groups
+
+def compact_group(group, output_uri, concurrency=8, s3_client=None):
+    """Merges the objects of group, in order, into one Parquet object under output_uri.
+
+    Returns the manifest entry of the merged object. Its "sources" list the
+    original entries it holds, those of entries compacted before included,
+    and its key is derived from them, so compacting the same entries again
+    rewrites the same object.
+    """
+    logger = logging.getLogger(__name__)
+    sources = [source for entry in group for source in entry.get("sources", [entry])]
+    name = hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()[:32]
+    bucket, prefix = output_uri[len("s3://"):].rstrip("/").split("/", 1)
+    key = f"{prefix}/{name}.parquet"
+
+    builder = DataBuilder(
+        tempfile.gettempdir(),
+        json.dumps({"data": group}),
+        concurrency=concurrency,
+        s3_client=s3_client,
+    )
+    df = concat_frames((df for _, df in builder.iter_sources()), ignore_index=True)
+    buffer = io.BytesIO()
+    df.to_parquet(buffer, index=False)
+    data = buffer.getvalue()
+
+    logger.info(
+        "Writing %d rows of %d objects to bucket: %s, key: %s", len(df), len(group), bucket, key
+    )
+    response = s3_client.put_object(Bucket=bucket, Key=key, Body=data)
+    return {
+        "bucketName": bucket,
+        "objectKey": key,
+        "format": "parquet",
+        "eTag": response["ETag"].strip('"'),
+        "size": len(data),
+        "rows": len(df),
+        "sources": sources,
+    }
+
+def compact(
+    manifest_uri,
+    output_uri,
+    target_bytes=default_target_bytes,
+    small_bytes=None,
+    concurrency=8,
+    s3_client=None,
+):
+    """Rewrites a manifest with its small objects merged into Parquet objects under output_uri.
+
+    Runs of consecutive entries smaller than small_bytes, a quarter of
+    target_bytes by default, are merged in manifest order. The new manifest
+    is written in a single put once all merged objects are uploaded; the
+    original objects are left in place. Returns the number of entries
+    merged and of objects written.
+
+    The manifest is only rewritten if it did not change meanwhile, see
+    write_manifest; otherwise a RuntimeError is raised, and the next run
+    compacts the new manifest.
+    """
+    logger = logging.getLogger(__name__)
+    if not output_uri.startswith("s3://"):
+        raise ValueError(f"Compacted objects must be written to S3, not {output_uri}")
+    s3_client = s3_client or boto3.client("s3")
+    manifest, version = read_manifest(manifest_uri, s3_client)
+    groups = plan_groups(manifest.get("data", []), target_bytes, small_bytes or target_bytes // 4)
+
+    data, merged, written = [], 0, 0
+    for group in groups:
+        if len(group) == 1:
+            data.append(group[0])
+            continue
+        data.append(compact_group(group, output_uri, concurrency, s3_client))
+        merged += len(group)
+        written += 1
+
+    if written:
+        logger.info("Rewriting %s with %d entries merged into %d.", manifest_uri, merged, written)
+        write_manifest(manifest_uri, dict(manifest, data=data), version, s3_client)
+    else:
+        logger.info("Nothing to compact in %s.", manifest_uri)
+    return {"merged": merged, "written": written}
+
+def lambda_handler(event, context):
+    """Compacts the data manifest, as configured by the environment, on a schedule.
+
+    The event may override the DATA_MANIFEST_URI, COMPACTED_DATA_URI and
+    COMPACTION_TARGET_BYTES settings with manifestUri, outputUri and
+    targetBytes.
+    """
+    logging.getLogger().setLevel(logging.INFO)
+    event = event or {}
+    manifest_uri = event.get("manifestUri", os.environ.get("DATA_MANIFEST_URI"))
+    output_uri = event.get("outputUri", os.environ.get("COMPACTED_DATA_URI"))
+    if not manifest_uri or not output_uri:
+        raise ValueError(
+            "Set DATA_MANIFEST_URI and COMPACTED_DATA_URI, or pass manifestUri and outputUri"
+        )
+    target_bytes = os.environ.get("COMPACTION_TARGET_BYTES", default_target_bytes)
+    return compact(manifest_uri, output_uri, int(event.get("targetBytes", target_bytes)))
+
+def run_main():
+    logger = logging.getLogger()
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--manifest-uri", type=str, required=True)
+    parser.add_argument("--output-uri", type=str, required=True)
+    parser.add_argument("--target-bytes", type=int, default=default_target_bytes)
+    parser.add_argument("--small-bytes", type=int, default=None)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    summary = compact(
+        args.manifest_uri,
+        args.output_uri,
+        args.target_bytes,
+        args.small_bytes,
+        args.concurrency,
+    )
+    logger.info("Merged %d entries into %d objects.", summary["merged"], summary["written"])
+
+if __name__ == "__main__":
+    run_main()
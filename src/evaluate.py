@@ -14,11 +14,18 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                                                              *
 
 """Evaluation script for measuring mean squared error."""
+import argparse
+import contextlib
 import json
 import logging
 import pathlib
 import pickle
+import resource
 import tarfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
@@ -27,6 +34,65 @@ import xgboost
 
 from sklearn.metrics import mean_squared_error
 
+class StageTimer:
+    """Sums the wall time, CPU time and calls of the stages of a run, once started by --profile.
+
+    A stage timed on the main thread also records the CPU time of the
+    process, the peak of the memory traced by tracemalloc, nested stages
+    included, and the peak resident memory of the process so far; one timed
+    on another thread records its thread CPU time. A lighter counterpart of
+    the stage profiler of preprocess.py, which this script is shipped without.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.stages = {}
+        self._peaks = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.enabled = True
+        tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        main = threading.current_thread() is threading.main_thread()
+        cpu_time = time.process_time if main else time.thread_time
+        if main:
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, cpu_time() - cpu
+            peaks = {}
+            if main:
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                peaks["traced_peak_bytes"] = peak
+                peaks["rss_peak_bytes"] = (
+                    resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+                )
+            # Part reads are timed on several threads at once.
+            with self._lock:
+                totals = self.stages.setdefault(
+                    name, {"calls": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0}
+                )
+                totals["calls"] += 1
+                totals["wall_seconds"] += wall
+                totals["cpu_seconds"] += cpu
+                for field, value in peaks.items():
+                    totals[field] = max(totals.get(field, 0), value)
+
+stage_timer = StageTimer()
+
 def is_within_directory(directory, target):         
     abs_directory = os.path.abspath(directory)
     abs_target = os.path.abspath(target)
@@ -42,34 +108,98 @@ def safe_extract(tar, path="."):
             raise Exception("Attempted Path Traversal in Tar File")
     tar.extractall(path) 
 
+def read_part(path):
+    """Reads one part of a split, label first; a .npy part is memory-mapped rather than parsed."""
+    with stage_timer.stage("read_part"):
+        if path.endswith(".npy"):
+            return np.load(path, mmap_mode="r")
+        if path.endswith(".parquet"):
+            return pd.read_parquet(path).to_numpy()
+        if os.path.getsize(path):
+            return pd.read_csv(path, header=None).to_numpy()
+        return np.empty((0, 0))
+
+def read_test_data(test_dir, index_dir=None, concurrency=8):
+    """Reads the parts of the test split, written by one or several hosts, in parallel.
+
+    When the preprocessing index lists every part, the parts it lists as
+    empty are skipped, and the row counts of the others size one output
+    array that each part is read straight into. A single part is returned
+    as read, so a .npy part stays memory-mapped.
+    """
+    names = [
+        name for name in sorted(os.listdir(test_dir))
+        if name.endswith((".npy", ".parquet", ".csv"))
+    ]
+
+    index = {}
+    if index_dir is not None and os.path.isdir(index_dir):
+        for index_name in sorted(os.listdir(index_dir)):
+            if index_name.startswith("test") and index_name.endswith(".json"):
+                with open(os.path.join(index_dir, index_name)) as f:
+                    split_index = json.load(f)
+                for part in split_index["parts"]:
+                    index[part["file"]] = (part["rows"], split_index["columns"])
+    indexed = set(names) <= set(index)
+    if indexed:
+        names = [name for name in names if index[name][0]]
+    if not names:
+        raise ValueError(f"No test data found in {test_dir}")
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        if indexed and len(names) > 1:
+            offsets = np.cumsum([0] + [index[name][0] for name in names])
+            test_data = np.empty((offsets[-1], max(index[name][1] for name in names)))
+
+            def read_into(name, offset):
+                rows = index[name][0]
+                test_data[offset:offset + rows] = read_part(os.path.join(test_dir, name))
+
+            list(executor.map(read_into, names, offsets[:-1]))
+            return test_data
+
+        parts = list(executor.map(read_part, [os.path.join(test_dir, name) for name in names]))
+    parts = [part for part in parts if len(part)]
+    if not parts:
+        raise ValueError(f"No test data found in {test_dir}")
+    return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profile", action="store_true")
+    args = parser.parse_args()
+    if args.profile:
+        stage_timer.start()
+
     logger.debug("Starting evaluation.")
     model_path = "/opt/ml/processing/model/model.tar.gz"
-    with tarfile.open(model_path) as tar: 
-        safe_extract(tar, path=".")
+    with stage_timer.stage("model_load"):
+        with tarfile.open(model_path) as tar: 
+            safe_extract(tar, path=".")
 
-    logger.debug("Loading xgboost model.")
-    model = pickle.load(open("xgboost-model", "rb"))
+        logger.debug("Loading xgboost model.")
+        model = pickle.load(open("xgboost-model", "rb"))
 
     logger.debug("Reading test data.")
-    test_path = "/opt/ml/processing/test/test.csv"
-    df = pd.read_csv(test_path, header=None)
+    with stage_timer.stage("read"):
+        test_data = read_test_data("/opt/ml/processing/test", "/opt/ml/processing/index")
 
     logger.debug("Reading test data.")
-    y_test = df.iloc[:, 0].to_numpy()
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_test = xgboost.DMatrix(df.values)
+    y_test = test_data[:, 0]
+    X_test = xgboost.DMatrix(test_data[:, 1:])
 
     logger.info("Performing predictions against test data.")
-    predictions = model.predict(X_test)
+    with stage_timer.stage("predict"):
+        predictions = model.predict(X_test)
 
     logger.debug("Calculating mean squared error.")
-    mse = mean_squared_error(y_test, predictions)
-    std = np.std(y_test - predictions)
+    with stage_timer.stage("metrics"):
+        mse = mean_squared_error(y_test, predictions)
+        std = np.std(y_test - predictions)
     report_dict = {
         "regression_metrics": {
             "mse": {"value": mse, "standard_deviation": std},
@@ -83,3 +213,8 @@ if __name__ == "__main__":
     evaluation_path = f"{output_dir}/evaluation.json"
     with open(evaluation_path, "w") as f:
         f.write(json.dumps(report_dict))
+
+    if args.profile:
+        logger.info("Writing the stage profile to %s.", output_dir)
+        with open(f"{output_dir}/profile.json", "w") as f:
+            json.dump({"stages": stage_timer.stages}, f, indent=2)
@@ -15,15 +15,31 @@
 
 """Feature engineers the abalone dataset."""
 import argparse
+import contextlib
+import cProfile
+import hashlib
+import io
 import logging
 import os
-import pathlib
 import json
+import resource
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import boto3
 import numpy as np
 import pandas as pd
 
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
 from sklearn.compose import ColumnTransformer
 from sklearn.impute import SimpleImputer
 from sklearn.pipeline import Pipeline
@@ -58,21 +74,776 @@ feature_columns_dtype = {
 
 label_column_dtype = {"rings": np.float64}
 
+categorical_columns_names = ["sex"]
+
+numeric_columns_names = [
+    column for column in feature_columns_names if column not in categorical_columns_names
+]
+
+# Input formats a manifest entry can point at, keyed by object key suffix.
+# An entry may also name its format explicitly through a "format" field.
+data_formats = {
+    ".csv": "csv",
+    ".csv.gz": "csv.gz",
+    ".csv.zst": "csv.zst",
+    ".parquet": "parquet",
+    ".arrow": "arrow",
+    ".feather": "arrow",
+}
+
+csv_compressions = {"csv": None, "csv.gz": "gzip", "csv.zst": "zstd"}
+
+# Formats the train, validation and test splits can be written in, with the
+# suffix of their files.
+output_formats = {
+    "csv": ".csv",
+    "parquet": ".parquet",
+    "npy": ".npy",
+    "recordio": ".pbr",
+}
+
+class StageProfiler:
+    """Records the wall time, CPU time and peak memory of the stages of a run.
+
+    A stage timed on the main thread records the CPU time of the process and
+    of its reaped child processes, the peak of the memory traced by
+    tracemalloc, nested stages included, and the peak resident memory of the
+    process so far. A stage timed on another thread, like a download, only
+    records its wall and thread CPU time. Repeated stages are summed. Stages
+    are not timed until the profiler is started.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._stages = {}
+        self._peaks = []
+        self._traced_peak = 0
+        self._lock = threading.Lock()
+        self._cprofile = None
+        self._start = None
+
+    def start(self, cprofile=False):
+        self.enabled = True
+        tracemalloc.start()
+        self._start = (time.perf_counter(), time.process_time())
+        if cprofile:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        main = threading.current_thread() is threading.main_thread()
+        cpu_time = time.process_time if main else time.thread_time
+        if main:
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._peaks.append(0)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield
+        finally:
+            record = {
+                "calls": 1,
+                "wall_seconds": time.perf_counter() - wall,
+                "cpu_seconds": cpu_time() - cpu,
+            }
+            if main:
+                usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+                record["children_cpu_seconds"] = (
+                    usage.ru_utime + usage.ru_stime - children.ru_utime - children.ru_stime
+                )
+                peak = max(self._peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                self._traced_peak = max(self._traced_peak, peak)
+                record["traced_peak_bytes"] = peak
+                record["rss_peak_bytes"] = _rss_peak_bytes()
+            else:
+                record["threaded"] = True
+            with self._lock:
+                totals = self._stages.setdefault(name, {})
+                for field, value in record.items():
+                    if field.endswith("_peak_bytes"):
+                        totals[field] = max(totals.get(field, 0), value)
+                    elif field == "threaded":
+                        totals[field] = value
+                    else:
+                        totals[field] = totals.get(field, 0) + value
+
+    def profile(self):
+        """Returns the recorded stages and the totals of the run as a JSON-serializable dict."""
+        wall, cpu = self._start
+        return {
+            "stages": self._stages,
+            "total": {
+                "wall_seconds": time.perf_counter() - wall,
+                "cpu_seconds": time.process_time() - cpu,
+                "traced_peak_bytes": max(self._traced_peak, tracemalloc.get_traced_memory()[1]),
+                "rss_peak_bytes": _rss_peak_bytes(),
+            },
+        }
+
+    def write(self, path):
+        """Stops profiling and writes the profile to the local path.
+
+        The cProfile statistics of the main thread, if kept, are written next
+        to it, with a .prof suffix.
+        """
+        write_uri(path, json.dumps(self.profile(), indent=2).encode())
+        self.enabled = False
+        tracemalloc.stop()
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(os.path.splitext(path)[0] + ".prof")
+
+def _rss_peak_bytes():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Times the stages of the run when started by --profile.
+stage_profiler = StageProfiler()
+
+class QuantileSketch:
+    """Mergeable KLL quantile sketch of a stream of numbers.
+
+    Items live in a hierarchy of compactors where an item at level h stands
+    for 2**h input values. A compactor over its capacity is sorted and every
+    other item, from a random offset, is promoted to the next level. With
+    ``k = ceil(2 / rank_error)`` the rank of a returned quantile is off by at
+    most about ``rank_error`` times the number of values seen, while only
+    O(k) items are kept however many values are added.
+    """
+
+    def __init__(self, rank_error=0.001, seed=0) -> None:
+        self.k = int(np.ceil(2 / rank_error))
+        self.count = 0
+        self.compactors = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self.compactors) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.compactors[0] = np.concatenate((self.compactors[0], values))
+        self._compress()
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self.compactors.append(np.empty(0))
+        for level, items in enumerate(other.compactors):
+            self.compactors[level] = np.concatenate((self.compactors[level], items))
+        self.count += other.count
+        self._compress()
+
+    def _compress(self):
+        while True:
+            for level, items in enumerate(self.compactors):
+                if len(items) > self._capacity(level):
+                    break
+            else:
+                return
+            if level + 1 == len(self.compactors):
+                self.compactors.append(np.empty(0))
+            items = np.sort(self.compactors[level])
+            # An odd item out stays behind so that no weight is lost.
+            odd = len(items) % 2
+            promoted = items[odd + self._rng.integers(2)::2]
+            self.compactors[level] = items[:odd]
+            self.compactors[level + 1] = np.concatenate((self.compactors[level + 1], promoted))
+
+    def to_dict(self):
+        return {
+            "k": self.k,
+            "count": self.count,
+            "compactors": [items.tolist() for items in self.compactors],
+        }
+
+    @classmethod
+    def from_dict(cls, value):
+        sketch = cls()
+        sketch.k = value["k"]
+        sketch.count = value["count"]
+        sketch.compactors = [np.array(items, dtype=np.float64) for items in value["compactors"]]
+        return sketch
+
+    def weighted_items(self):
+        """Returns the retained items and the number of input values each stands for."""
+        items = np.concatenate(self.compactors)
+        weights = np.concatenate([
+            np.full(len(level_items), 2.0 ** level)
+            for level, level_items in enumerate(self.compactors)
+        ])
+        return items, weights
+
+    def quantile(self, q):
+        if not self.count:
+            return np.nan
+        items, weights = self.weighted_items()
+        order = np.argsort(items, kind="stable")
+        cumulative = np.cumsum(weights[order])
+        return items[order][np.searchsorted(cumulative, q * cumulative[-1])]
+
+class NumericStatistics:
+    """Mergeable fit statistics of one numeric column.
+
+    Keeps the count, range, mean and sum of squared deviations of the
+    observed values, merged with Chan et al.'s parallel update. The median
+    and other quantiles come from the count of every distinct value, which
+    is exact, or from a QuantileSketch when a rank error is given, which
+    bounds memory however many distinct values there are.
+    """
+
+    def __init__(self, rank_error=None) -> None:
+        self.count = 0
+        self.nulls = 0
+        self.min = np.nan
+        self.max = np.nan
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.value_counts = pd.Series(dtype=np.float64)
+        self.sketch = QuantileSketch(rank_error) if rank_error else None
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        observed = values[~np.isnan(values)]
+        chunk = NumericStatistics()
+        chunk.nulls = len(values) - len(observed)
+        chunk.count = len(observed)
+        if chunk.count:
+            chunk.min = float(observed.min())
+            chunk.max = float(observed.max())
+            chunk.mean = float(observed.mean())
+            chunk.m2 = float(((observed - chunk.mean) ** 2).sum())
+            if self.sketch is None:
+                chunk.value_counts = pd.Series(observed).value_counts()
+        if self.sketch is not None:
+            self.sketch.update(observed)
+        self.merge(chunk)
+
+    def merge(self, other):
+        self.count, self.mean, self.m2 = _merge_moments(
+            (self.count, self.mean, self.m2), (other.count, other.mean, other.m2)
+        )
+        self.nulls += other.nulls
+        self.min = float(np.fmin(self.min, other.min))
+        self.max = float(np.fmax(self.max, other.max))
+        self.value_counts = self.value_counts.add(other.value_counts, fill_value=0)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "nulls": self.nulls,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean,
+            "m2": self.m2,
+            "value_counts": _value_counts_to_dict(self.value_counts),
+            "sketch": self.sketch.to_dict() if self.sketch is not None else None,
+        }
+
+    @classmethod
+    def from_dict(cls, value):
+        statistics = cls()
+        statistics.count = value["count"]
+        statistics.nulls = value["nulls"]
+        # Statistics saved before the range was tracked have none.
+        statistics.min = value.get("min", np.nan)
+        statistics.max = value.get("max", np.nan)
+        statistics.mean = value["mean"]
+        statistics.m2 = value["m2"]
+        statistics.value_counts = _value_counts_from_dict(value["value_counts"])
+        if value["sketch"] is not None:
+            statistics.sketch = QuantileSketch.from_dict(value["sketch"])
+        return statistics
+
+    def median(self):
+        if not self.count:
+            return np.nan
+        if self.sketch is not None:
+            return self.sketch.quantile(0.5)
+        counts = self.value_counts.sort_index()
+        positions = np.cumsum(counts.to_numpy())
+        lower = counts.index[np.searchsorted(positions, (self.count - 1) // 2, side="right")]
+        upper = counts.index[np.searchsorted(positions, self.count // 2, side="right")]
+        return (lower + upper) / 2
+
+    def quantile(self, q):
+        if not self.count:
+            return np.nan
+        if self.sketch is not None:
+            return self.sketch.quantile(q)
+        counts = self.value_counts.sort_index()
+        positions = np.cumsum(counts.to_numpy())
+        position = q * (self.count - 1)
+        lower = counts.index[np.searchsorted(positions, np.floor(position), side="right")]
+        upper = counts.index[np.searchsorted(positions, np.ceil(position), side="right")]
+        return lower + (upper - lower) * (position - np.floor(position))
+
+    def histogram(self, bins=20):
+        """Returns equal-width bin edges over the observed range and the count in each bin."""
+        if not self.count:
+            return np.empty(0), np.empty(0)
+        if self.sketch is not None:
+            values, weights = self.sketch.weighted_items()
+        else:
+            values, weights = self.value_counts.index.to_numpy(), self.value_counts.to_numpy()
+        if self.max == self.min:
+            return np.array([self.min, self.max]), np.array([weights.sum()])
+        edges = np.linspace(self.min, self.max, bins + 1)
+        counts, _ = np.histogram(values, edges, weights=weights)
+        return edges, counts
+
+    def imputed_moments(self, fill_value):
+        """Returns count, mean and variance once nulls are replaced by fill_value."""
+        count, mean, m2 = _merge_moments(
+            (self.count, self.mean, self.m2), (self.nulls, fill_value, 0.0)
+        )
+        return count, mean, m2 / count if count else 0.0
+
+class CategoricalStatistics:
+    """Mergeable fit statistics of one categorical column."""
+
+    def __init__(self) -> None:
+        self.nulls = 0
+        self.value_counts = pd.Series(dtype=np.float64)
+
+    def update(self, values):
+        values = pd.Series(values)
+        value_counts = values.value_counts()
+        # Categorical columns also count the categories that do not occur.
+        value_counts = value_counts[value_counts > 0]
+        value_counts.index = value_counts.index.astype(object)
+        self.merge_counts(int(values.isna().sum()), value_counts)
+
+    def merge(self, other):
+        self.merge_counts(other.nulls, other.value_counts)
+
+    def merge_counts(self, nulls, value_counts):
+        self.nulls += nulls
+        self.value_counts = self.value_counts.add(value_counts, fill_value=0)
+
+    def to_dict(self):
+        return {"nulls": self.nulls, "value_counts": _value_counts_to_dict(self.value_counts)}
+
+    @classmethod
+    def from_dict(cls, value):
+        statistics = cls()
+        statistics.nulls = value["nulls"]
+        statistics.value_counts = _value_counts_from_dict(value["value_counts"])
+        return statistics
+
+class FitStatistics:
+    """Statistics of the raw data that DataProcessor needs to fit its transforms.
+
+    They are computed one chunk at a time and can be merged, so the whole
+    dataset never has to be held in memory.
+    """
+
+    def __init__(self, rank_error=None) -> None:
+        self.rows = 0
+        self.label = NumericStatistics(rank_error)
+        self.numeric = {
+            column: NumericStatistics(rank_error) for column in numeric_columns_names
+        }
+        self.categorical = {
+            column: CategoricalStatistics() for column in categorical_columns_names
+        }
+
+    def update(self, df):
+        self.rows += len(df)
+        if label_column in df:
+            self.label.update(df[label_column].to_numpy())
+        for column, statistics in self.numeric.items():
+            statistics.update(df[column].to_numpy())
+        for column, statistics in self.categorical.items():
+            statistics.update(df[column])
+
+    def merge(self, other):
+        self.rows += other.rows
+        self.label.merge(other.label)
+        for column, statistics in self.numeric.items():
+            statistics.merge(other.numeric[column])
+        for column, statistics in self.categorical.items():
+            statistics.merge(other.categorical[column])
+
+    def to_dict(self):
+        return {
+            "rows": self.rows,
+            "label": self.label.to_dict(),
+            "numeric": {column: value.to_dict() for column, value in self.numeric.items()},
+            "categorical": {
+                column: value.to_dict() for column, value in self.categorical.items()
+            },
+        }
+
+    @classmethod
+    def from_dict(cls, value):
+        statistics = cls()
+        statistics.rows = value["rows"]
+        if "label" in value:
+            statistics.label = NumericStatistics.from_dict(value["label"])
+        statistics.numeric = {
+            column: NumericStatistics.from_dict(value["numeric"][column])
+            for column in numeric_columns_names
+        }
+        statistics.categorical = {
+            column: CategoricalStatistics.from_dict(value["categorical"][column])
+            for column in categorical_columns_names
+        }
+        return statistics
+
+    def columns(self):
+        """Yields the name and statistics of every column, label included, in file order."""
+        for column in feature_columns_names:
+            if column in self.numeric:
+                yield column, self.numeric[column]
+            else:
+                yield column, self.categorical[column]
+        yield label_column, self.label
+
+    def summary(self):
+        """Returns the per-column null counts and ranges or categories, without distributions."""
+        columns = {}
+        for column, statistics in self.columns():
+            if isinstance(statistics, CategoricalStatistics):
+                columns[column] = {
+                    "nulls": statistics.nulls,
+                    "categories": sorted(str(value) for value in statistics.value_counts.index),
+                }
+            else:
+                columns[column] = {
+                    "nulls": statistics.nulls,
+                    "min": _json_number(statistics.min),
+                    "max": _json_number(statistics.max),
+                }
+        return {"rows": self.rows, "columns": columns}
+
+def _json_number(value):
+    return None if np.isnan(value) else float(value)
+
+def source_name(value):
+    """Names the source of a manifest entry, by its source_key if it has a version."""
+    return source_key(value) or f"{value['bucketName']}/{value['objectKey']}"
+
+def source_key(value):
+    """Identifies the content of a manifest entry, or None if it has no version.
+
+    Only entries that carry a versionId or eTag can be matched across runs,
+    since the same object key may hold different data over time.
+    """
+    version = value.get("versionId") or value.get("eTag")
+    if version is None:
+        return None
+    version = version.strip('"')
+    return f"{value['bucketName']}/{value['objectKey']}@{version}"
+
+def load_source_statistics(text, median_rank_error=None):
+    """Parses per-source FitStatistics saved by dump_source_statistics.
+
+    Statistics gathered with a different median rank error are discarded
+    because their medians are not comparable.
+    """
+    value = json.loads(text)
+    if value.get("median_rank_error") != median_rank_error:
+        return {}
+    return {key: FitStatistics.from_dict(item) for key, item in value["sources"].items()}
+
+def dump_source_statistics(source_statistics, median_rank_error=None):
+    return json.dumps({
+        "median_rank_error": median_rank_error,
+        "sources": {key: item.to_dict() for key, item in source_statistics.items()},
+    })
+
+class DataProfiler:
+    """Profiles the raw data source by source in the pass that gathers the fit statistics.
+
+    The FitStatistics of every source are merged into those of the whole
+    dataset, which both fit DataProcessor and make up the profile, so
+    profiling costs no extra pass over the data. The statistics of a source
+    found in previous_source_statistics are reused rather than recomputed.
+    Those of a source that a DedupIndex dropped rows of are neither reused
+    nor kept, as they only hold while the same rows are dropped.
+    """
+
+    def __init__(
+        self, median_rank_error=None, previous_source_statistics=None, dedup=None
+    ) -> None:
+        self._median_rank_error = median_rank_error
+        self._previous_source_statistics = previous_source_statistics or {}
+        self._dedup = dedup
+        self.statistics = FitStatistics(median_rank_error)
+        self.source_statistics = {}
+        self.source_summaries = {}
+        self.reused = 0
+
+    def update(self, value, chunk):
+        """Adds the raw data of one manifest entry."""
+        key = source_key(value)
+        if self._dedup is not None and self._dedup.dropped.get(source_name(value)):
+            key = None
+        chunk_statistics = self._previous_source_statistics.get(key)
+        if chunk_statistics is None:
+            chunk_statistics = FitStatistics(self._median_rank_error)
+            chunk_statistics.update(chunk)
+        else:
+            self.reused += 1
+        self.statistics.merge(chunk_statistics)
+        if key is not None:
+            self.source_statistics[key] = chunk_statistics
+        self.source_summaries[source_name(value)] = chunk_statistics.summary()
+
+    def to_dict(self):
+        return {
+            "statistics": self.statistics.to_dict(),
+            "sources": {key: item.to_dict() for key, item in self.source_statistics.items()},
+            "summaries": self.source_summaries,
+            "reused": self.reused,
+        }
+
+    @classmethod
+    def from_dict(cls, value, median_rank_error=None):
+        profiler = cls(median_rank_error)
+        profiler.statistics = FitStatistics.from_dict(value["statistics"])
+        profiler.source_statistics = {
+            key: FitStatistics.from_dict(item) for key, item in value["sources"].items()
+        }
+        profiler.source_summaries = value["summaries"]
+        profiler.reused = value["reused"]
+        return profiler
+
+    def gather(self, rendezvous):
+        """Replaces the statistics with those of all hosts, merged in rank order."""
+        parts = rendezvous.all_gather("statistics", json.dumps(self.to_dict()).encode())
+        self.statistics = FitStatistics(self._median_rank_error)
+        for value in map(json.loads, parts):
+            self.statistics.merge(FitStatistics.from_dict(value["statistics"]))
+            for key, item in value["sources"].items():
+                self.source_statistics.setdefault(key, FitStatistics.from_dict(item))
+            self.source_summaries.update(value["summaries"])
+
+    def profile(self, bins=20, quantiles=(0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)):
+        """Returns the profile of the data as a JSON-serializable dict."""
+        rows = self.statistics.rows
+        columns = {}
+        for column, statistics in self.statistics.columns():
+            column_profile = {
+                "nulls": statistics.nulls,
+                "null_fraction": statistics.nulls / rows if rows else 0.0,
+            }
+            if isinstance(statistics, CategoricalStatistics):
+                column_profile["type"] = "categorical"
+                column_profile["counts"] = {
+                    str(value): int(count) for value, count in statistics.value_counts.items()
+                }
+            else:
+                edges, counts = statistics.histogram(bins)
+                column_profile.update(
+                    type="numeric",
+                    count=statistics.count,
+                    min=_json_number(statistics.min),
+                    max=_json_number(statistics.max),
+                    mean=statistics.mean if statistics.count else None,
+                    std=np.sqrt(statistics.m2 / statistics.count) if statistics.count else None,
+                    quantiles={
+                        str(q): _json_number(statistics.quantile(q)) for q in quantiles
+                    },
+                    histogram={"edges": edges.tolist(), "counts": counts.tolist()},
+                )
+            columns[column] = column_profile
+        return {
+            "rows": rows,
+            "columns": columns,
+            "sources": self.source_summaries,
+            "drift": self.drift(),
+        }
+
+    def drift(self):
+        """Lists where the schema of a source differs from the rest of the data.
+
+        Reported are columns that are entirely null in a source although
+        observed elsewhere, and categories found in only one of several
+        sources.
+        """
+        category_sources = {}
+        for name, summary in self.source_summaries.items():
+            for column in categorical_columns_names:
+                for category in summary["columns"][column]["categories"]:
+                    category_sources.setdefault((column, category), []).append(name)
+
+        drift = []
+        for name, summary in self.source_summaries.items():
+            for column, statistics in self.statistics.columns():
+                if isinstance(statistics, CategoricalStatistics):
+                    observed = statistics.value_counts.sum()
+                else:
+                    observed = statistics.count
+                nulls = summary["columns"][column]["nulls"]
+                if summary["rows"] and nulls == summary["rows"] and observed:
+                    drift.append({"source": name, "column": column, "issue": "all_null"})
+            if len(self.source_summaries) < 2:
+                continue
+            for column in categorical_columns_names:
+                categories = [
+                    category
+                    for category in summary["columns"][column]["categories"]
+                    if category_sources[column, category] == [name]
+                ]
+                if categories:
+                    drift.append({
+                        "source": name,
+                        "column": column,
+                        "issue": "new_categories",
+                        "categories": categories,
+                    })
+        return drift
+
+def _value_counts_to_dict(value_counts):
+    return {"values": value_counts.index.tolist(), "counts": value_counts.tolist()}
+
+def _value_counts_from_dict(value):
+    return pd.Series(value["counts"], index=value["values"], dtype=np.float64)
+
+def _merge_moments(a, b):
+    """Merges (count, mean, m2) moments of two disjoint sets of values."""
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if not count_b:
+        return count_a, mean_a, m2_a
+    if not count_a:
+        return count_b, mean_b, m2_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+def pack_arrays(arrays):
+    """Packs named arrays into one byte array, returning it and the index of their layout.
+
+    Each array is aligned to 8 bytes, so that it can be viewed in place with
+    its dtype and shape once the byte array is memory-mapped.
+    """
+    arrays = {name: np.asarray(array) for name, array in arrays.items()}
+    index, size = {}, 0
+    for name, array in arrays.items():
+        size += -size % 8
+        index[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": size,
+            "size": array.nbytes,
+        }
+        size += array.nbytes
+    data = np.zeros(size, dtype=np.uint8)
+    for name, array in arrays.items():
+        offset = index[name]["offset"]
+        data[offset:offset + array.nbytes] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+    return data, index
+
 class DataProcessor:
     @property
     def _logger(self):
         return logging.getLogger(__name__)
 
-    def __init__(self, input_data) -> None:
+    def __init__(self, input_data, low_memory=False, workers=1) -> None:
         self._input_data = input_data
-        self._logger.debug("Defining transformers.")
-        numeric_features = list(feature_columns_names)
-        numeric_features.remove("sex")
+        self._low_memory = low_memory
+        self._workers = workers
+        self._executor = None
+        self._preprocess = self._define_transformers()
+
+        self._logger.debug("Fitting transforms.")
+        self._input_data_y = self._input_data.pop("rings")
+        self._preprocess.fit(self._input_data)
+
+    @classmethod
+    def from_statistics(cls, statistics, sample, low_memory=False, workers=1):
+        """Creates a processor fitted from FitStatistics rather than from the data.
+
+        The sample, a chunk of the raw data, only lays out the fitted
+        transformers; their learned parameters are then replaced with the
+        ones derived from the statistics of the whole dataset. Without a
+        sample, as on a host that got no data, a placeholder row is used.
+        """
+        if sample is None:
+            sample = pd.DataFrame({column: [0.0] for column in numeric_columns_names})
+            for column in categorical_columns_names:
+                sample[column] = pd.Series(["missing"], dtype=object)
+            sample[label_column] = 0.0
+            sample = sample[feature_columns_names + [label_column]]
+        data_processor = cls.__new__(cls)
+        data_processor._input_data = None
+        data_processor._input_data_y = None
+        data_processor._low_memory = low_memory
+        data_processor._workers = workers
+        data_processor._executor = None
+        data_processor._preprocess = cls._define_transformers()
+
+        data_processor._logger.debug("Fitting transforms from statistics.")
+        data_processor._preprocess.fit(sample.drop(columns=[label_column]))
+
+        numeric_transformer = data_processor._preprocess.named_transformers_["num"]
+        medians = np.array(
+            [statistics.numeric[column].median() for column in numeric_columns_names]
+        )
+        numeric_transformer.named_steps["imputer"].statistics_ = medians
+
+        moments = [
+            statistics.numeric[column].imputed_moments(median)
+            for column, median in zip(numeric_columns_names, medians)
+        ]
+        scaler = numeric_transformer.named_steps["scaler"]
+        scaler.n_samples_seen_ = statistics.rows
+        scaler.mean_ = np.array([mean for _, mean, _ in moments])
+        scaler.var_ = np.array([var for _, _, var in moments])
+        scale = np.sqrt(scaler.var_)
+        scale[scale == 0.0] = 1.0
+        scaler.scale_ = scale
+
+        # The categorical pipeline is cheap to refit on one row per category.
+        categorical = {}
+        for column in categorical_columns_names:
+            column_statistics = statistics.categorical[column]
+            values = list(column_statistics.value_counts.index)
+            if column_statistics.nulls:
+                values.append(np.nan)
+            categorical[column] = values
+        categorical_sample = pd.DataFrame(categorical, dtype=object)
+        data_processor._preprocess.named_transformers_["cat"].fit(categorical_sample)
+
+        return data_processor
+
+    @classmethod
+    def load(cls, model_path, low_memory=False, workers=1):
+        """Creates a processor from the transforms saved by save_model."""
+        data_processor = cls.__new__(cls)
+        data_processor._input_data = None
+        data_processor._input_data_y = None
+        data_processor._low_memory = low_memory
+        data_processor._workers = workers
+        data_processor._executor = None
+        data_processor._preprocess = joblib.load(os.path.join(model_path, "model.joblib"))
+        return data_processor
+
+    @staticmethod
+    def _define_transformers():
+        logging.getLogger(__name__).debug("Defining transformers.")
+        numeric_features = list(numeric_columns_names)
         numeric_transformer = Pipeline(
             steps=[("imputer", SimpleImputer(strategy="median")), ("scaler", StandardScaler())]
         )
 
-        categorical_features = ["sex"]
+        categorical_features = list(categorical_columns_names)
         categorical_transformer = Pipeline(
             steps=[
                 ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
@@ -80,38 +851,648 @@ class DataProcessor:
             ]
         )
 
-        self._preprocess = ColumnTransformer(
+        return ColumnTransformer(
             transformers=[
                 ("num", numeric_transformer, numeric_features),
                 ("cat", categorical_transformer, categorical_features),
             ]
         )
 
-        self._logger.debug("Fitting transforms.")
-        self._input_data_y = self._input_data.pop("rings")
-        self._preprocess.fit(self._input_data)
+    def compile(self):
+        """Returns the fitted transforms as plain arrays, for transform.py to apply with NumPy.
+
+        The numeric columns are imputed with the medians, centered on the
+        means and divided by the scales. The categorical columns follow,
+        their missing values imputed with missing_category, each one-hot
+        encoded over its sorted slice of categories, which starts at its
+        entry of category_offsets.
+        """
+        numeric_transformer = self._preprocess.named_transformers_["num"]
+        medians = numeric_transformer.named_steps["imputer"].statistics_
+        scaler = numeric_transformer.named_steps["scaler"]
+        categorical_transformer = self._preprocess.named_transformers_["cat"]
+        categories = categorical_transformer.named_steps["onehot"].categories_
+        # The imputer drops the columns it saw no values of.
+        kept = ~np.isnan(medians)
+        return {
+            "numeric_columns": np.array(numeric_columns_names)[kept],
+            "medians": medians[kept],
+            "means": scaler.mean_,
+            "scales": scaler.scale_,
+            "categorical_columns": np.array(categorical_columns_names),
+            "missing_category": np.array(
+                categorical_transformer.named_steps["imputer"].fill_value
+            ),
+            "categories": np.concatenate(categories).astype(str),
+            "category_offsets": np.cumsum([0] + [len(values) for values in categories]),
+        }
 
     def save_model(self, model_path):
+        """Saves model.joblib and the compiled arrays packed into compiled.npy.
+
+        Both are written uncompressed so that transform.py can memory-map
+        them instead of reading them into every serving worker.
+        """
         model_joblib_path = os.path.join(model_path, "model.joblib")
+        model_compiled_path = os.path.join(model_path, "compiled.npy")
+        model_index_path = os.path.join(model_path, "compiled.json")
         model_tar_path = os.path.join(model_path, "model.tar.gz")
         joblib.dump(self._preprocess, model_joblib_path)
+        data, index = pack_arrays(self.compile())
+        np.save(model_compiled_path, data, allow_pickle=False)
+        with open(model_index_path, "w") as f:
+            json.dump(index, f)
         tar = tarfile.open(model_tar_path, "w:gz")
         tar.add(model_joblib_path, arcname="model.joblib")
+        tar.add(model_compiled_path, arcname="compiled.npy")
+        tar.add(model_index_path, arcname="compiled.json")
         tar.close()
 
     def process(self):
         self._logger.debug("Applying transforms.")
+        if self._workers > 1 and len(self._input_data):
+            return self._process_parallel(self._input_data, self._input_data_y)
+        if self._low_memory:
+            return self._process_into_buffer(self._input_data, self._input_data_y)
+
         x_pre = self._preprocess.transform(self._input_data)
         y_pre = self._input_data_y.to_numpy().reshape(len(self._input_data_y), 1)
 
         return np.concatenate((y_pre, x_pre), axis=1)
 
+    def process_chunk(self, df):
+        """Transforms a chunk of raw data, returning the label as the first column."""
+        y = df.pop(label_column)
+        if not len(df):
+            # sklearn rejects input without rows.
+            return np.empty((0, 1 + len(self._preprocess.get_feature_names_out())))
+        if self._workers > 1 and len(df):
+            return self._process_parallel(df, y)
+        if self._low_memory:
+            return self._process_into_buffer(df, y)
+
+        y_pre = y.to_numpy().reshape(len(df), 1)
+        x_pre = self._preprocess.transform(df)
+
+        return np.concatenate((y_pre, x_pre), axis=1)
+
+    def close(self):
+        """Shuts down the transform worker processes, if any were started."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _process_into_buffer(self, x, y, block_rows=65536):
+        """Transforms x block by block into one preallocated float32 output.
+
+        The label is written to the first column and the transformed features
+        of every block straight after it, so no full-size float64
+        intermediate is created.
+        """
+        n_features = len(self._preprocess.get_feature_names_out())
+        output = np.empty((len(x), 1 + n_features), dtype=np.float32)
+        output[:, 0] = y.to_numpy()
+        for start in range(0, len(x), block_rows):
+            output[start:start + block_rows, 1:] = self._preprocess.transform(
+                x.iloc[start:start + block_rows]
+            )
+        return output
+
+    def _process_parallel(self, x, y, blocks_per_worker=4):
+        """Transforms x across a pool of worker processes.
+
+        Every column of x and the output array are memory-mapped files that
+        the workers map too, so only row ranges and file names are pickled;
+        each worker transforms its blocks and writes them in place into the
+        shared output. The transforms work row by row, so the result is
+        identical to the serial path.
+        """
+        if self._executor is None:
+            self._logger.debug("Starting %d transform workers.", self._workers)
+            self._executor = ProcessPoolExecutor(
+                self._workers,
+                initializer=_init_transform_worker,
+                initargs=(self._preprocess,),
+            )
+
+        n_features = len(self._preprocess.get_feature_names_out())
+        dtype = np.float32 if self._low_memory else np.float64
+        shared_dir = tempfile.mkdtemp(prefix="transform-")
+        try:
+            columns = []
+            for column in x.columns:
+                values = x[column]
+                categories = None
+                categorical = isinstance(values.dtype, pd.CategoricalDtype)
+                if categorical or not pd.api.types.is_numeric_dtype(values.dtype):
+                    codes = pd.Categorical(values)
+                    categories = list(codes.categories)
+                    values = codes.codes
+                else:
+                    values = values.to_numpy()
+                path = os.path.join(shared_dir, f"{len(columns)}.bin")
+                values.tofile(path)
+                columns.append((column, path, values.dtype.str, categories, categorical))
+
+            output_spec = (os.path.join(shared_dir, "output.bin"), np.dtype(dtype).str, n_features)
+            output = np.memmap(output_spec[0], dtype=dtype, mode="w+", shape=(len(x), 1 + n_features))
+            output[:, 0] = y.to_numpy()
+
+            block_rows = -(-len(x) // (self._workers * blocks_per_worker))
+            blocks = [
+                (columns, output_spec, start, min(start + block_rows, len(x)))
+                for start in range(0, len(x), block_rows)
+            ]
+            for _ in self._executor.map(_transform_block, blocks):
+                pass
+        finally:
+            # The mapping of the output outlives its unlinked file.
+            shutil.rmtree(shared_dir)
+        return output
+
     def merge_two_dicts(x, y):
         """Merges two dicts, returning a new copy."""
         z = x.copy()
         z.update(y)
         return z
 
+_transform_worker_state = {}
+
+def _init_transform_worker(preprocess):
+    _transform_worker_state["preprocess"] = preprocess
+
+def _transform_block(block):
+    """Transforms one block of rows from the shared columns into the shared output."""
+    columns, (output_path, output_dtype, n_features), start, end = block
+    data = {}
+    for column, path, dtype, categories, categorical in columns:
+        values = np.memmap(path, dtype=dtype, mode="r")[start:end]
+        if categories is not None:
+            values = pd.Series(pd.Categorical.from_codes(values, categories))
+            if not categorical:
+                values = _as_str(values)
+        data[column] = values
+    output = np.memmap(output_path, dtype=output_dtype, mode="r+")
+    output = output.reshape(-1, 1 + n_features)
+    output[start:end, 1:] = _transform_worker_state["preprocess"].transform(pd.DataFrame(data))
+    output.flush()
+
+def column_dtypes(low_memory=False):
+    """Returns the dtypes to read the feature and label columns with.
+
+    In low-memory mode numeric columns are read as float32 and string
+    columns as categoricals, which roughly halves the memory per row.
+    """
+    dtypes = DataProcessor.merge_two_dicts(feature_columns_dtype, label_column_dtype)
+    if low_memory:
+        dtypes = {
+            column: "category" if dtype is str else np.float32 for column, dtype in dtypes.items()
+        }
+    return dtypes
+
+def _as_str(values):
+    # Match read_csv, which keeps missing strings as NaN.
+    return values.astype(str).where(values.notna(), np.nan)
+
+def _apply_dtypes(df, dtypes=None):
+    """Casts the feature and label columns of df to the given or declared dtypes."""
+    for column, dtype in (dtypes or column_dtypes()).items():
+        values = df[column]
+        if dtype is str:
+            df[column] = _as_str(values)
+        else:
+            df[column] = values.astype(dtype)
+    return df
+
+def concat_frames(frames, ignore_index=False):
+    """Concatenates frames, keeping categorical columns categorical.
+
+    pd.concat falls back to object columns when the categories of the
+    frames differ, so the categories are unioned first.
+    """
+    frames = list(frames)
+    for column in frames[0].columns:
+        if isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            categories = pd.api.types.union_categoricals(
+                [frame[column] for frame in frames], ignore_order=True
+            ).categories
+            for frame in frames:
+                frame[column] = frame[column].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=ignore_index)
+
+def write_frame(path, df):
+    """Writes df to the directory path as one .npy array per column.
+
+    String and categorical columns are stored as category codes so that
+    every column can be memory-mapped back by read_frame.
+    """
+    os.makedirs(path, exist_ok=True)
+    meta = {"columns": list(df.columns), "categories": {}, "categorical": []}
+    for index, column in enumerate(df.columns):
+        values = df[column]
+        if values.dtype.kind not in "biuf":
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                meta["categorical"].append(column)
+            categorical = pd.Categorical(values)
+            meta["categories"][column] = categorical.categories.tolist()
+            values = categorical.codes
+        np.save(os.path.join(path, f"{index}.npy"), np.asarray(values))
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+def read_frame(path):
+    """Reads a frame written by write_frame, memory-mapping its columns."""
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    data = {}
+    for index, column in enumerate(meta["columns"]):
+        values = np.load(os.path.join(path, f"{index}.npy"), mmap_mode="r")
+        if column in meta["categories"]:
+            values = pd.Series(pd.Categorical.from_codes(values, meta["categories"][column]))
+            if column not in meta.get("categorical", []):
+                values = _as_str(values)
+        data[column] = values
+    return pd.DataFrame(data)
+
+def _ordered_map(executor, fn, items, window):
+    """Maps fn over items on the executor, yielding results in input order.
+
+    At most ``window`` calls are queued or running ahead of the result being
+    consumed, which bounds the memory held by results that are not yet used.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(fn, item))
+        if len(pending) > window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+class _JsonStream:
+    """Decodes JSON values one at a time from a text file read in blocks."""
+
+    def __init__(self, f, block_size):
+        self._f = f
+        self._block_size = block_size
+        self._decoder = json.JSONDecoder()
+        self._buf = ""
+        self._eof = False
+
+    def _fill(self):
+        block = self._f.read(self._block_size)
+        self._eof = not block
+        self._buf += block
+        return not self._eof
+
+    def peek(self):
+        """Returns the next non-whitespace character without consuming it."""
+        while True:
+            self._buf = self._buf.lstrip()
+            if self._buf or not self._fill():
+                return self._buf[:1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Malformed data manifest: expected one of {chars!r}, got {char!r}")
+        self._buf = self._buf[1:]
+        return char
+
+    def decode(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # A number that ends the buffer may continue in the next block.
+            if end == len(self._buf) and self._fill():
+                continue
+            self._buf = self._buf[end:]
+            return value
+
+def iter_manifest_entries(f, json_lines=False, block_size=1 << 16):
+    """Yields the data entries of a manifest file without loading it whole.
+
+    The manifest is either a JSON object whose "data" array lists the
+    entries, which are decoded one at a time, or JSON Lines with one entry
+    per line.
+    """
+    if json_lines:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+        return
+
+    stream = _JsonStream(f, block_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+    while True:
+        key = stream.decode()
+        stream.expect(":")
+        if key == "data":
+            stream.expect("[")
+            if stream.peek() == "]":
+                stream.expect("]")
+            else:
+                while True:
+                    yield stream.decode()
+                    if stream.expect(",]") == "]":
+                        break
+        else:
+            stream.decode()
+        if stream.expect(",}") == "}":
+            return
+
+class IngestCache:
+    """Local cache of parsed manifest objects.
+
+    Each entry is a directory of column arrays keyed by bucket, object key and
+    object version (ETag or version id), so an object that changes in S3 is
+    never served stale. String columns are stored as category codes. Entries
+    are read back memory-mapped, and the least recently used ones are evicted
+    once the cache grows beyond ``max_bytes``.
+    """
+
+    @property
+    def _logger(self):
+        return logging.getLogger(__name__)
+
+    def __init__(self, cache_dir, max_bytes=None) -> None:
+        self._cache_dir = cache_dir
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self._entries = {}
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.startswith(".") or not os.path.isdir(path):
+                continue
+            self._entries[name] = (os.path.getmtime(path), self._dir_size(path))
+        self._evict()
+
+    @staticmethod
+    def _dir_size(path):
+        return sum(entry.stat().st_size for entry in os.scandir(path))
+
+    @staticmethod
+    def entry_name(bucket, key, version, dtypes=None):
+        schema = repr(sorted((dtypes or column_dtypes()).items(), key=lambda item: item[0]))
+        return hashlib.sha256(f"{bucket}/{key}/{version}/{schema}".encode()).hexdigest()
+
+    def get(self, bucket, key, version, dtypes=None):
+        name = self.entry_name(bucket, key, version, dtypes)
+        path = os.path.join(self._cache_dir, name)
+        with self._lock:
+            if name not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            os.utime(path)
+            self._entries[name] = (os.path.getmtime(path), self._entries[name][1])
+
+        return read_frame(path)
+
+    def put(self, bucket, key, version, df, dtypes=None):
+        name = self.entry_name(bucket, key, version, dtypes)
+        staging = tempfile.mkdtemp(prefix=".", dir=self._cache_dir)
+        write_frame(staging, df)
+
+        path = os.path.join(self._cache_dir, name)
+        with self._lock:
+            if name in self._entries:
+                shutil.rmtree(staging)
+                return
+            os.rename(staging, path)
+            self._entries[name] = (os.path.getmtime(path), self._dir_size(path))
+            self._evict()
+
+    def _evict(self):
+        if self._max_bytes is None:
+            return
+        total = sum(size for _, size in self._entries.values())
+        for name in sorted(self._entries, key=lambda name: self._entries[name][0]):
+            if total <= self._max_bytes:
+                break
+            self._logger.debug("Evicting ingest cache entry %s", name)
+            total -= self._entries.pop(name)[1]
+            shutil.rmtree(os.path.join(self._cache_dir, name), ignore_errors=True)
+
+def normalized_rows(df):
+    """Returns the feature and label columns of df in a form that hashes the same
+    for the same row however it was read.
+
+    Strings are stripped, and numbers are rounded to float32 so that rows
+    read in low-memory mode match those read in full precision.
+    """
+    columns = {}
+    for column in feature_columns_names + [label_column]:
+        if column in categorical_columns_names:
+            columns[column] = _as_str(df[column].astype(object)).str.strip()
+        else:
+            columns[column] = df[column].astype(np.float32)
+    return pd.DataFrame(columns)
+
+class DedupIndex:
+    """Index of the 64-bit hashes of ingested rows and the source that owns each.
+
+    A row is dropped when its hash is owned by another source of the current
+    manifest, so data uploaded in overlapping extracts is kept only once,
+    while a source that is ingested again keeps its own rows. A hash whose
+    owner left the manifest passes to the source that has it now. The index
+    is saved as sorted hash and owner arrays, pruned to the sources of the
+    current manifest, and loaded again by the next run.
+    """
+
+    @property
+    def _logger(self):
+        return logging.getLogger(__name__)
+
+    def __init__(self, uri=None) -> None:
+        self._uri = uri
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._owners = np.empty(0, dtype=np.int64)
+        self._names = []
+        self._live = np.empty(0, dtype=bool)
+        self.dropped = {}
+        data = read_uri(uri) if uri else None
+        if data is not None:
+            with np.load(io.BytesIO(data)) as index:
+                self._hashes = index["hashes"]
+                self._owners = index["owners"].astype(np.int64)
+                self._names = index["names"].tolist()
+        self._ids = {name: owner for owner, name in enumerate(self._names)}
+        self._live = np.zeros(len(self._names), dtype=bool)
+
+    def _owner(self, name):
+        if name not in self._ids:
+            self._ids[name] = len(self._names)
+            self._names.append(name)
+            self._live = np.append(self._live, True)
+        return self._ids[name]
+
+    def start(self, names):
+        """Starts a run over the sources of the current manifest.
+
+        Only the sources already in the index are marked, so names may be a
+        stream over a manifest of any size; the others are added as their
+        rows are filtered.
+        """
+        self._live[:] = False
+        for name in names:
+            owner = self._ids.get(name)
+            if owner is not None:
+                self._live[owner] = True
+
+    def filter(self, name, df):
+        """Returns df without the rows owned by another source, claiming the rest for name."""
+        owner = self._owner(name)
+        hashes = pd.util.hash_pandas_object(normalized_rows(df), index=False).to_numpy()
+        found = np.zeros(len(hashes), dtype=bool)
+        owners = np.full(len(hashes), owner)
+        if len(self._hashes):
+            positions = np.minimum(np.searchsorted(self._hashes, hashes), len(self._hashes) - 1)
+            found = self._hashes[positions] == hashes
+            owners[found] = self._owners[positions[found]]
+            # Hashes of sources that left the manifest pass to this one.
+            self._owners[positions[found & ~self._live[owners]]] = owner
+        drop = (owners != owner) & self._live[owners]
+
+        # Both are sorted, so the new hashes are merged in without sorting the index.
+        new_hashes = np.unique(hashes[~found])
+        positions = np.searchsorted(self._hashes, new_hashes)
+        self._hashes = np.insert(self._hashes, positions, new_hashes)
+        self._owners = np.insert(self._owners, positions, owner)
+
+        if drop.any():
+            self.dropped[name] = self.dropped.get(name, 0) + int(drop.sum())
+            self._logger.info("Dropped %d duplicate rows from %s.", drop.sum(), name)
+            df = df[~drop]
+        return df
+
+    def dump(self):
+        """Returns the hashes owned by the sources of the current manifest, as npz bytes."""
+        live = self._live[self._owners]
+        kept, owners = np.unique(self._owners[live], return_inverse=True)
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            hashes=self._hashes[live],
+            owners=owners.astype(np.uint32),
+            names=np.array([self._names[owner] for owner in kept], dtype=str),
+        )
+        return buffer.getvalue()
+
+    def save(self):
+        """Saves the hashes owned by the sources of the current manifest to the index URI."""
+        write_uri(self._uri, self.dump())
+
+def parse_sample(value):
+    """Parses a --sample value into a (fraction, count) pair, or None for no sampling."""
+    if value in (None, "", "all"):
+        return None
+    if "." in value or "e" in value.lower():
+        fraction = float(value)
+        if not 0 < fraction <= 1:
+            raise ValueError(f"Sample fraction {value} must be in (0, 1]")
+        return fraction, None
+    count = int(value)
+    if count <= 0:
+        raise ValueError(f"Sample count {value} must be positive")
+    return None, count
+
+class RowSampler:
+    """Samples the rows of the raw data while it is ingested.
+
+    Every row gets a uniform random priority drawn from a stream seeded by
+    the seed, its object and its position there, so a sample is
+    reproducible. With a fraction, the rows whose priority is below it are
+    kept (Bernoulli sampling). With a count, the count rows of lowest
+    priority over all objects are kept (bottom-k reservoir sampling); when
+    stratified, every rings value gets a share of the count in proportion to
+    its frequency. CSV objects are parsed and sampled block_rows rows at a
+    time, which bounds the memory taken by an object and is faster than
+    skipping rows through a per-row parser callback.
+    """
+
+    priority_column = "_sample_priority"
+    block_rows = 65536
+
+    def __init__(self, fraction=None, count=None, seed=None, stratify=False) -> None:
+        if (fraction is None) == (count is None):
+            raise ValueError("Exactly one of fraction and count is required")
+        self.fraction = fraction
+        self.count = count
+        self._seed = 0 if seed is None else seed
+        self._stratify = stratify
+        self._threshold = fraction if fraction is not None else 1.0
+        self._reservoir = None
+        self._values = []
+        self._strata = pd.Series(dtype=np.float64)
+
+    def _priorities(self, name, piece, block):
+        seed = [self._seed, zlib.crc32(name.encode()), piece, block]
+        return np.random.default_rng(seed).random(self.block_rows)
+
+    def select(self, name, piece, df, block=0):
+        """Samples the rows of a piece of an object from the given block on.
+
+        The priority of each row kept is added to it in count mode.
+        """
+        threshold = self._threshold
+        blocks = range(block, block - (-len(df) // self.block_rows))
+        priorities = np.concatenate(
+            [self._priorities(name, piece, block) for block in blocks] or [np.empty(0)]
+        )[:len(df)]
+        df = df[priorities < threshold].copy()
+        if self.count is not None:
+            df[self.priority_column] = priorities[priorities < threshold]
+        return df
+
+    def add(self, value, df):
+        """Offers the sampled rows of a manifest entry to the reservoir, in count mode."""
+        df = df.assign(_sample_source=len(self._values), _sample_row=np.arange(len(df)))
+        self._values.append(value)
+        self._strata = self._strata.add(_strata(df).value_counts(), fill_value=0)
+        if self._reservoir is not None:
+            df = concat_frames([self._reservoir, df], ignore_index=True)
+        df = df.sort_values(self.priority_column, kind="stable")
+        if self._stratify:
+            self._reservoir = df.groupby(_strata(df)).head(self.count)
+        else:
+            self._reservoir = df.head(self.count)
+            if len(self._reservoir) == self.count:
+                self._threshold = self._reservoir[self.priority_column].iloc[-1]
+
+    def finish(self):
+        """Yields the sampled rows of every manifest entry, in manifest order, in count mode."""
+        if self._reservoir is None:
+            return
+        df = self._reservoir
+        if self._stratify and self._strata.sum() > self.count:
+            # Largest remainder apportionment of the count over the strata.
+            quotas = self.count * self._strata / self._strata.sum()
+            shares = np.floor(quotas)
+            remainder = int(self.count - shares.sum())
+            order = (quotas - shares).sort_values(ascending=False, kind="stable").index
+            shares[order[:remainder]] += 1
+            strata = _strata(df)
+            ranks = df.groupby(strata).cumcount().to_numpy()
+            df = df[ranks < shares.reindex(strata).to_numpy()]
+        df = df.sort_values(["_sample_source", "_sample_row"])
+        df = df.drop(columns=[self.priority_column, "_sample_row"])
+        for index, rows in df.groupby("_sample_source", sort=True):
+            yield self._values[index], rows.drop(columns=["_sample_source"]).reset_index(drop=True)
+
+def _strata(df):
+    # Missing labels form a stratum of their own.
+    return df[label_column].astype(np.float64).fillna(np.inf)
+
 class DataBuilder: 
     @property
     def _logger(self):
@@ -121,39 +1502,998 @@ class DataBuilder:
     def data_manifest(self):
         return self._data_manifest
 
-    def __init__(self, base_dir, data_manifest) -> None:
+    @property
+    def dedup(self):
+        return self._dedup
+
+    @property
+    def _s3_client(self):
+        # A single client is shared by all download threads so that its
+        # connection pool is reused rather than re-established per object.
+        if self._s3 is None:
+            max_connections = self._concurrency * (
+                self._multipart_concurrency if self._multipart_threshold else 1
+            )
+            self._s3 = boto3.client(
+                "s3", config=Config(max_pool_connections=max(10, max_connections))
+            )
+        return self._s3
+
+    def __init__(
+        self,
+        base_dir,
+        data_manifest=None,
+        concurrency=1,
+        multipart_threshold=None,
+        multipart_concurrency=8,
+        cache=None,
+        s3_client=None,
+        data_manifest_file=None,
+        low_memory=False,
+        rank=0,
+        hosts=1,
+        dedup=None,
+        sampler=None,
+    ) -> None:
+        if (data_manifest is None) == (data_manifest_file is None):
+            raise ValueError("Exactly one of data_manifest and data_manifest_file is required")
         self._base_dir = base_dir
-        self._data_manifest = json.loads(data_manifest)
+        self._data_manifest = json.loads(data_manifest) if data_manifest is not None else None
+        self._data_manifest_file = data_manifest_file
+        self._concurrency = max(1, concurrency)
+        self._multipart_threshold = multipart_threshold
+        self._multipart_concurrency = max(1, multipart_concurrency)
+        self._cache = cache
+        self._s3 = s3_client
+        self._dtypes = column_dtypes(low_memory)
+        self._rank = rank
+        self._hosts = hosts
+        self._dedup = dedup
+        self._sampler = sampler
 
     def build(self):
-        self._logger.info("Loading data from data manifest %s", self._data_manifest)
-        data_paths = self._data_manifest.get("data")
+        if self._data_manifest_file is not None:
+            self._logger.info("Loading data from data manifest file %s", self._data_manifest_file)
+        else:
+            self._logger.info("Loading data from data manifest %s", self._data_manifest)
 
-        df_array = []
-        for index, value in enumerate(data_paths):
-            df = self._download_file(index, value["bucketName"], value["objectKey"])
-            df_array.append(df)
+        df_array = list(self.iter_chunks())
 
         if len(df_array):
-            return pd.concat(df_array)
+            return concat_frames(df_array)
+
+    def iter_chunks(self):
+        """Yields the raw data one manifest object at a time, in manifest order."""
+        for _, df in self.iter_sources():
+            yield df
+
+    def iter_sources(self):
+        """Yields every manifest entry along with its raw data, in manifest order.
+
+        With a DedupIndex, rows already ingested from another source of the
+        manifest are dropped; the manifest is then read twice, and its prefix
+        entries listed twice. With a RowSampler, only sampled rows are
+        yielded; a sample of a fixed count is only known once every entry
+        has been read, so the entries are then yielded at the end. Sources
+        left without rows are not yielded.
+        """
+        if self._dedup is None:
+            frames = self._iter_frames(self.iter_entries())
+        else:
+            # A first pass over the manifest marks its sources, rather than
+            # holding every entry in memory until the frames are read.
+            self._dedup.start(source_name(value) for value in self.iter_entries())
+            frames = (
+                (value, self._dedup.filter(source_name(value), df))
+                for value, df in self._iter_frames(self.iter_entries())
+            )
+
+        if self._sampler is None or self._sampler.count is None:
+            # A source left without rows, such as a re-uploaded copy or a
+            # small object none of whose rows were sampled, is skipped.
+            yield from ((value, df) for value, df in frames if len(df))
+        else:
+            for value, df in frames:
+                self._sampler.add(value, df)
+            yield from self._sampler.finish()
+
+        if self._dedup is not None:
+            self._logger.info(
+                "Dropped %d duplicate rows from %d sources.",
+                sum(self._dedup.dropped.values()),
+                len(self._dedup.dropped),
+            )
+        if self._cache is not None:
+            self._logger.info(
+                "Ingest cache: %d hits, %d misses", self._cache.hits, self._cache.misses
+            )
+
+    def iter_entries(self):
+        """Yields the manifest entries to ingest, expanding S3 prefix entries.
+
+        An entry with a "prefix" instead of an "objectKey" stands for every
+        object under that prefix. When the data is split over several hosts,
+        only every hosts-th object, starting at this host's rank, is yielded.
+        """
+        index = 0
+        for value in self._iter_manifest():
+            for entry in self._expand_prefix(value) if "prefix" in value else [value]:
+                if index % self._hosts == self._rank:
+                    yield entry
+                index += 1
+
+    def _iter_manifest(self):
+        if self._data_manifest_file is None:
+            yield from self._data_manifest.get("data", [])
+            return
+        with open(self._data_manifest_file) as f:
+            yield from iter_manifest_entries(
+                f, json_lines=self._data_manifest_file.endswith(".jsonl")
+            )
+
+    def _expand_prefix(self, value):
+        """Lists the objects under a prefix entry in key order.
+
+        The prefix is listed one level deep first; the child prefixes found
+        there are then listed in parallel, each through its own pagination.
+        The keys under a child prefix sort together, so the objects of the
+        first level are merged in between them by key. Hosts shard the data
+        by this order.
+        """
+        bucket, prefix = value["bucketName"], value["prefix"]
+        self._logger.info("Listing data in bucket: %s, prefix: %s", bucket, prefix)
+        template = {field: item for field, item in value.items() if field != "prefix"}
+
+        def list_prefix(item):
+            child_prefix, delimiter = item
+            entries, children = [], []
+            kwargs = {"Bucket": bucket, "Prefix": child_prefix}
+            if delimiter:
+                kwargs["Delimiter"] = delimiter
+            while True:
+                response = self._s3_client.list_objects_v2(**kwargs)
+                for content in response.get("Contents", []):
+                    if content["Key"].endswith("/"):
+                        continue
+                    entries.append(
+                        dict(
+                            template,
+                            objectKey=content["Key"],
+                            eTag=content["ETag"].strip('"'),
+                            size=content["Size"],
+                        )
+                    )
+                children.extend(common["Prefix"] for common in response.get("CommonPrefixes", []))
+                if not response.get("IsTruncated"):
+                    return entries, children
+                kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+        entries, children = list_prefix((prefix, "/"))
+        entries = deque(entries)
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            listings = _ordered_map(
+                executor, list_prefix, ((child, None) for child in children), self._concurrency
+            )
+            for child, (child_entries, _) in zip(children, listings):
+                while entries and entries[0]["objectKey"] < child:
+                    yield entries.popleft()
+                yield from child_entries
+        yield from entries
 
-    def _download_file(self, index, bucket, key):
-        pathlib.Path(f"{self._base_dir}/data").mkdir(parents=True, exist_ok=True)
+    def _iter_frames(self, data_paths):
+        """Yields every manifest entry with its parsed frame, in manifest order.
 
-        self._logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
-        fn = f"{self._base_dir}/data/{index}.csv"
-        s3 = boto3.resource("s3")
-        s3.Bucket(bucket).download_file(key, fn)
+        With a concurrency above one, up to that many objects are downloaded
+        and parsed in the background while the caller consumes the oldest one.
+        """
+        def download(item):
+            index, value = item
+            return value, self._load_entry(index, value)
 
-        self._logger.debug("Reading raw input data.")
-        df = pd.read_csv(
-            fn,
+        if self._concurrency == 1:
+            for item in enumerate(data_paths):
+                yield download(item)
+            return
+
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            yield from _ordered_map(executor, download, enumerate(data_paths), self._concurrency)
+
+    def _load_entry(self, index, value):
+        bucket, key = value["bucketName"], value["objectKey"]
+        # Sampled frames are not cached, as they are only part of the object.
+        if self._cache is None or self._sampler is not None:
+            return self._download_file(index, bucket, key, self._data_format(value))
+
+        version = value.get("versionId") or value.get("eTag")
+        if version is None:
+            version = self._s3_client.head_object(Bucket=bucket, Key=key)["ETag"]
+        version = version.strip('"')
+
+        df = self._cache.get(bucket, key, version, self._dtypes)
+        if df is None:
+            df = self._download_file(index, bucket, key, self._data_format(value))
+            self._cache.put(bucket, key, version, df, self._dtypes)
+        else:
+            self._logger.info("Loaded cached data for bucket: %s, key: %s", bucket, key)
+        return df
+
+    @staticmethod
+    def _data_format(value):
+        if "format" in value:
+            if value["format"] not in data_formats.values():
+                raise ValueError(f"Unsupported data format {value['format']!r}")
+            return value["format"]
+        key = value["objectKey"].lower()
+        for suffix in sorted(data_formats, key=len, reverse=True):
+            if key.endswith(suffix):
+                return data_formats[suffix]
+        return "csv"
+
+    def _download_file(self, index, bucket, key, data_format="csv"):
+        self._logger.info("Downloading %s data from bucket: %s, key: %s", data_format, bucket, key)
+        if self._multipart_threshold:
+            return self._download_ranges(index, bucket, key, data_format)
+        sample_key = (f"{bucket}/{key}", 0)
+
+        with stage_profiler.stage("download"):
+            response = self._s3_client.get_object(Bucket=bucket, Key=key)
+
+        self._logger.debug("Reading raw input data %d.", index)
+        body = response["Body"]
+        try:
+            if data_format in csv_compressions:
+                # Streamed, so that the download is timed as part of the parse.
+                return self._read_object(body, data_format, sample_key)
+            # Columnar readers need a seekable source.
+            with stage_profiler.stage("download"):
+                data = body.read()
+            return self._read_object(io.BytesIO(data), data_format, sample_key)
+        finally:
+            body.close()
+
+    def _download_ranges(self, index, bucket, key, data_format="csv"):
+        """Downloads an object as byte ranges of ``multipart_threshold`` bytes.
+
+        The first range also tells us the object size. Objects that do not fit
+        in it have their remaining ranges fetched in parallel. Plain CSV ranges
+        are parsed as soon as they and their predecessors are available,
+        carrying the trailing partial line over to the next range; other
+        formats are parsed once all ranges are joined back together.
+        """
+        part_size = self._multipart_threshold
+        name = f"{bucket}/{key}"
+        with stage_profiler.stage("download"):
+            first = self._get_range(bucket, key, 0, part_size)
+            size = int(first["ContentRange"].rsplit("/", 1)[1])
+            head = first["Body"].read()
+        if size <= part_size:
+            self._logger.debug("Reading raw input data %d.", index)
+            return self._read_object(io.BytesIO(head), data_format, (name, 0))
+
+        self._logger.debug(
+            "Reading raw input data %d as %d ranges.", index, -(-size // part_size)
+        )
+
+        def download(start):
+            with stage_profiler.stage("download"):
+                return self._get_range(bucket, key, start, part_size)["Body"].read()
+
+        with ThreadPoolExecutor(max_workers=self._multipart_concurrency) as executor:
+            blocks = _ordered_map(
+                executor, download, range(part_size, size, part_size), self._multipart_concurrency
+            )
+            if data_format != "csv":
+                return self._read_object(
+                    io.BytesIO(head + b"".join(blocks)), data_format, (name, 0)
+                )
+
+            frames = []
+            carry = head
+            for piece, block in enumerate(blocks):
+                data = carry + block
+                cut = data.rfind(b"\n") + 1
+                if cut:
+                    frames.append(self._read_csv(io.BytesIO(data[:cut]), sample_key=(name, piece)))
+                carry = data[cut:]
+            if carry.strip():
+                frames.append(self._read_csv(io.BytesIO(carry), sample_key=(name, piece + 1)))
+
+        return concat_frames(frames, ignore_index=True)
+
+    def _get_range(self, bucket, key, start, length):
+        return self._s3_client.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes={start}-{start + length - 1}"
+        )
+
+    def _read_object(self, source, data_format, sample_key=None):
+        if data_format in csv_compressions:
+            return self._read_csv(source, csv_compressions[data_format], sample_key)
+
+        columns = feature_columns_names + [label_column]
+        with stage_profiler.stage("parse"):
+            if data_format == "parquet":
+                df = pd.read_parquet(source, columns=columns)
+            else:
+                df = pd.read_feather(source, columns=columns)
+            df = _apply_dtypes(df, self._dtypes)
+        if self._sampler is not None:
+            df = self._sampler.select(*sample_key, df)
+        return df
+
+    def _read_csv(self, source, compression=None, sample_key=None):
+        kwargs = dict(
             header=None,
             names=feature_columns_names + [label_column],
-            dtype=DataProcessor.merge_two_dicts(feature_columns_dtype, label_column_dtype),
+            dtype=self._dtypes,
+            compression=compression,
         )
-        os.unlink(fn)   
-        return df
+        if self._sampler is None:
+            with stage_profiler.stage("parse"):
+                return pd.read_csv(source, **kwargs)
+
+        # Sampled a block at a time, so that only the kept rows of the object are held.
+        frames = []
+        with pd.read_csv(source, chunksize=self._sampler.block_rows, **kwargs) as reader:
+            while True:
+                with stage_profiler.stage("parse"):
+                    df = next(reader, None)
+                if df is None:
+                    break
+                frames.append(self._sampler.select(*sample_key, df, len(frames)))
+        return concat_frames(frames)
+
+def read_uri(uri, s3_client=None):
+    """Reads an s3:// URI or local path, returning None if it does not exist."""
+    if not uri.startswith("s3://"):
+        if not os.path.exists(uri):
+            return None
+        with open(uri, "rb") as f:
+            return f.read()
+
+    bucket, key = uri[len("s3://"):].split("/", 1)
+    try:
+        response = (s3_client or boto3.client("s3")).get_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None
+        raise
+    return response["Body"].read()
+
+def write_uri(uri, data, s3_client=None):
+    """Writes data to an s3:// URI or local path."""
+    if not uri.startswith("s3://"):
+        directory = os.path.dirname(os.path.abspath(uri))
+        os.makedirs(directory, exist_ok=True)
+        # Written aside and renamed, so that readers never see a partial file.
+        with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+            f.write(data)
+        os.replace(f.name, uri)
+        return
+
+    bucket, key = uri[len("s3://"):].split("/", 1)
+    (s3_client or boto3.client("s3")).put_object(Bucket=bucket, Key=key, Body=data)
+
+def host_rank(resource_config="/opt/ml/config/resourceconfig.json"):
+    """Returns the rank of this host and the number of hosts of the processing job."""
+    if not os.path.exists(resource_config):
+        return 0, 1
+    with open(resource_config) as f:
+        config = json.load(f)
+    return config["hosts"].index(config["current_host"]), len(config["hosts"])
+
+def host_share(count, rank, hosts):
+    """Returns the part of count taken by the host of rank, the remainder going to the first."""
+    return count // hosts + (rank < count % hosts)
+
+class Rendezvous:
+    """Exchanges partial results between the hosts of a processing job.
+
+    Every host writes its part under a shared directory or S3 prefix and
+    waits for the parts of all the others, so the prefix must be unique to
+    the job.
+    """
+
+    @property
+    def _logger(self):
+        return logging.getLogger(__name__)
+
+    def __init__(self, uri, rank, hosts, timeout=3600, poll_interval=5, s3_client=None) -> None:
+        self._uri = uri.rstrip("/")
+        self.rank = rank
+        self.hosts = hosts
+        self._timeout = timeout
+        self._poll_interval = poll_interval
+        self._s3 = s3_client
+
+    def publish(self, name, data):
+        """Publishes data as this host's part of name."""
+        write_uri(f"{self._uri}/{name}-{self.rank}", data, self._s3)
+
+    def all_gather(self, name, data):
+        """Publishes data as this host's part of name and returns every host's part, by rank."""
+        self.publish(name, data)
+        parts = [None] * self.hosts
+        deadline = time.monotonic() + self._timeout
+        while True:
+            for rank, part in enumerate(parts):
+                if part is None:
+                    parts[rank] = read_uri(f"{self._uri}/{name}-{rank}", self._s3)
+            missing = [rank for rank, part in enumerate(parts) if part is None]
+            if not missing:
+                return parts
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Hosts {missing} did not publish {name} to {self._uri}")
+            self._logger.debug("Waiting for hosts %s to publish %s.", missing, name)
+            time.sleep(self._poll_interval)
+
+def copy_tree(source, destination, s3_client=None):
+    """Copies the files under a directory or S3 prefix to another directory or S3 prefix."""
+    s3 = s3_client
+    if s3 is None and "s3://" in (source[:5], destination[:5]):
+        s3 = boto3.client("s3")
+    if source.startswith("s3://"):
+        bucket, prefix = source[len("s3://"):].split("/", 1)
+        names = []
+        kwargs = {"Bucket": bucket, "Prefix": prefix + "/"}
+        while True:
+            response = s3.list_objects_v2(**kwargs)
+            names.extend(
+                content["Key"][len(prefix) + 1:] for content in response.get("Contents", [])
+            )
+            if not response.get("IsTruncated"):
+                break
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+    else:
+        names = [
+            os.path.relpath(os.path.join(root, name), source).replace(os.sep, "/")
+            for root, _, files in os.walk(source)
+            for name in files
+        ]
+
+    for name in names:
+        source_path, destination_path = f"{source}/{name}", f"{destination}/{name}"
+        if source.startswith("s3://") and destination.startswith("s3://"):
+            write_uri(destination_path, read_uri(source_path, s3), s3)
+        elif source.startswith("s3://"):
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            s3.download_file(bucket, f"{prefix}/{name}", destination_path)
+        elif destination.startswith("s3://"):
+            s3.upload_file(source_path, *destination_path[len("s3://"):].split("/", 1))
+        else:
+            os.makedirs(os.path.dirname(destination_path), exist_ok=True)
+            shutil.copyfile(source_path, destination_path)
+
+def fingerprint(*inputs):
+    """Returns a digest of inputs, each bytes or a JSON-serializable value."""
+    digest = hashlib.sha256()
+    for value in inputs:
+        if not isinstance(value, bytes):
+            value = json.dumps(value, sort_keys=True).encode()
+        digest.update(hashlib.sha256(value).digest())
+    return digest.hexdigest()[:32]
+
+checkpoint_ignored_arguments = {
+    "checkpoint_uri",
+    "base_dir",
+    "download_concurrency",
+    "multipart_threshold",
+    "multipart_concurrency",
+    "cache_dir",
+    "cache_max_bytes",
+    "transform_workers",
+    "rendezvous_uri",
+    "rendezvous_timeout",
+    "profile",
+    "cprofile",
+}
+
+class Checkpoint:
+    """Durable outputs of the preprocessing stages, kept under a directory or S3 prefix.
+
+    The local output directories of a stage are copied under
+    {uri}/{fingerprint}/{stage}/ before the stage is marked complete, so a
+    rerun with the same fingerprint, a digest of the manifest, the code and
+    the arguments, restores them instead of running the stage again. A run
+    that succeeds clears its checkpoint.
+    """
+
+    @property
+    def _logger(self):
+        return logging.getLogger(__name__)
+
+    def __init__(self, uri, fingerprint, s3_client=None) -> None:
+        self._uri = f"{uri.rstrip('/')}/{fingerprint}"
+        self._s3 = s3_client
+
+    def done(self, stage):
+        return read_uri(f"{self._uri}/{stage}.done", self._s3) is not None
+
+    def save(self, stage, paths):
+        """Copies the directories in paths, keyed by name, and marks stage complete."""
+        self._logger.info("Checkpointing stage %s to %s.", stage, self._uri)
+        with stage_profiler.stage("checkpoint"):
+            for name, path in paths.items():
+                if os.path.isdir(path):
+                    copy_tree(path, f"{self._uri}/{stage}/{name}", self._s3)
+        write_uri(f"{self._uri}/{stage}.done", json.dumps(sorted(paths)).encode(), self._s3)
+
+    def restore(self, stage, paths):
+        """Copies the checkpointed directories of stage back to paths, keyed by name."""
+        self._logger.info("Restoring stage %s from %s.", stage, self._uri)
+        with stage_profiler.stage("checkpoint"):
+            for name, path in paths.items():
+                copy_tree(f"{self._uri}/{stage}/{name}", path, self._s3)
+
+    def clear(self):
+        """Deletes everything checkpointed under the fingerprint."""
+        self._logger.info("Clearing the checkpoint %s.", self._uri)
+        if not self._uri.startswith("s3://"):
+            shutil.rmtree(self._uri, ignore_errors=True)
+            return
+        s3 = self._s3 or boto3.client("s3")
+        bucket, prefix = self._uri[len("s3://"):].split("/", 1)
+        # The first page is listed again after each delete, as the listing shrinks.
+        while True:
+            response = s3.list_objects_v2(Bucket=bucket, Prefix=prefix + "/")
+            keys = [{"Key": content["Key"]} for content in response.get("Contents", [])]
+            if not keys:
+                break
+            # A page holds at most the 1000 keys a delete request takes.
+            s3.delete_objects(Bucket=bucket, Delete={"Objects": keys, "Quiet": True})
+
+split_names = ["train", "validation", "test"]
+
+class DatasetSplitter:
+    """Splits transformed rows into the train, validation and test datasets.
+
+    In "shuffle" mode the rows are shuffled, seeded if a seed is given, and
+    cut by the ratios. In "hash" mode every row goes to the split picked by
+    a seeded 64-bit hash of its raw feature values, so that a row lands in
+    the same split in every run without shuffling the whole dataset.
+    """
+
+    def __init__(self, mode="shuffle", ratios=(0.7, 0.15, 0.15), seed=None) -> None:
+        if mode not in ("shuffle", "hash"):
+            raise ValueError(f"Unsupported split mode {mode!r}")
+        if len(ratios) != len(split_names) or not np.isclose(sum(ratios), 1.0):
+            raise ValueError(f"Split ratios {ratios} must be three fractions that sum to 1")
+        self._mode = mode
+        self._bounds = np.cumsum(ratios)[:-1]
+        self.seed = seed
+        self._rng = np.random.default_rng(seed) if seed is not None else np.random
+
+    def split(self, data_output, raw=None):
+        """Splits data_output, whose rows were transformed from the rows of raw."""
+        if self._mode == "shuffle":
+            len_data_output = len(data_output)
+            self._rng.shuffle(data_output)
+            return np.split(data_output, [int(bound * len_data_output) for bound in self._bounds])
+
+        hash_key = hashlib.md5(str(self.seed or 0).encode()).hexdigest()[:16]
+        hashes = pd.util.hash_pandas_object(
+            raw[feature_columns_names], index=False, hash_key=hash_key
+        ).to_numpy()
+        assignment = np.searchsorted(self._bounds, hashes / 2.0 ** 64, side="right")
+        return [data_output[assignment == index] for index in range(len(split_names))]
+
+class SplitWriter:
+    """Appends rows to the train, validation and test outputs as they are produced.
+
+    With shuffle_buckets, each split is shuffled externally: rows are first
+    scattered at random over that many binary bucket files, and on close
+    every bucket is shuffled in memory and appended to the output, so only
+    one bucket is held in memory at a time.
+
+    The splits are written in output_format; the test split, which is read
+    by the evaluation rather than by training, may use its own test_format.
+    A host writing only its part of the splits names its files by part.
+
+    With shards, every split is written as that many part files instead of
+    one, row i of the split going to part i % shards so the parts stay
+    balanced, and an index of the parts' row counts and byte sizes is
+    written to {base_dir}/index.
+    """
+
+    def __init__(
+        self,
+        base_dir,
+        shuffle_buckets=0,
+        seed=None,
+        output_format="csv",
+        test_format=None,
+        part=None,
+        shards=0,
+    ) -> None:
+        self._base_dir = base_dir
+        self._shuffle_buckets = shuffle_buckets
+        self._rng = np.random.default_rng(seed)
+        self._part = part
+        self._formats = dict.fromkeys(split_names, output_format)
+        self._formats["test"] = test_format or output_format
+        self._outputs = {}
+        for name in split_names:
+            if shards:
+                first = (part or 0) * shards
+                paths = [
+                    split_path(base_dir, name, self._formats[name], shard=first + shard)
+                    for shard in range(shards)
+                ]
+            else:
+                paths = [split_path(base_dir, name, self._formats[name], part)]
+            self._outputs[name] = [SplitFile(path, self._formats[name]) for path in paths]
+        self._shards = shards
+        self._buckets = {}
+        self._width = None
+        self.rows = dict.fromkeys(split_names, 0)
+
+    def write(self, name, rows):
+        self.rows[name] += len(rows)
+        if not self._shuffle_buckets:
+            self._write_output(name, rows)
+            return
+
+        self._width = rows.shape[1]
+        assignment = self._rng.integers(self._shuffle_buckets, size=len(rows))
+        for bucket in np.unique(assignment):
+            if (name, bucket) not in self._buckets:
+                shuffle_dir = os.path.join(self._base_dir, "shuffle")
+                os.makedirs(shuffle_dir, exist_ok=True)
+                self._buckets[name, bucket] = open(
+                    os.path.join(shuffle_dir, f"{name}-{bucket}.bin"), "wb"
+                )
+            rows[assignment == bucket].astype(np.float64).tofile(self._buckets[name, bucket])
+
+    def close(self):
+        for bucket_file in self._buckets.values():
+            bucket_file.close()
+        for name in split_names:
+            for bucket in range(self._shuffle_buckets):
+                if (name, bucket) not in self._buckets:
+                    continue
+                path = self._buckets[name, bucket].name
+                rows = np.fromfile(path).reshape(-1, self._width)
+                self._rng.shuffle(rows)
+                self._write_output(name, rows)
+                os.unlink(path)
+            for output in self._outputs[name]:
+                output.close()
+            if self._shards:
+                self._write_index(name)
+        shutil.rmtree(os.path.join(self._base_dir, "shuffle"), ignore_errors=True)
+
+    def _write_output(self, name, rows):
+        outputs = self._outputs[name]
+        written = sum(output.rows for output in outputs)
+        for index, output in enumerate(outputs):
+            shard_rows = rows[(index - written) % len(outputs)::len(outputs)]
+            if len(shard_rows):
+                output.write(shard_rows)
+
+    def _write_index(self, name):
+        outputs = self._outputs[name]
+        index = {
+            "format": self._formats[name],
+            "rows": sum(output.rows for output in outputs),
+            "columns": max(output.columns for output in outputs),
+            "parts": [
+                {
+                    "file": os.path.basename(output.path),
+                    "rows": output.rows,
+                    "bytes": os.path.getsize(output.path),
+                }
+                for output in outputs
+            ],
+        }
+        index_name = name if self._part is None else f"{name}-{self._part:05d}"
+        write_uri(
+            os.path.join(self._base_dir, "index", f"{index_name}.json"),
+            json.dumps(index).encode(),
+        )
+
+def _npy_header(shape, dtype, size=128):
+    # A fixed-size header, so it can be rewritten once the row count is known.
+    header = repr({"descr": np.dtype(dtype).str, "fortran_order": False, "shape": tuple(shape)})
+    header = header.ljust(size - 11) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+def _varint(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def _length_delimited(field, size):
+    return _varint(field << 3 | 2) + _varint(size)
+
+def _dense_tensor_entry(field, size):
+    """Header of a Record map entry "values" holding size bytes of float32 values."""
+    tensor = _length_delimited(1, size)
+    value = _length_delimited(2, len(tensor) + size) + tensor
+    entry = _length_delimited(1, 6) + b"values" + _length_delimited(2, len(value) + size) + value
+    return _length_delimited(field, len(entry) + size) + entry
+
+def encode_recordio_protobuf(rows):
+    """Encodes rows, label first, as dense float32 RecordIO-protobuf records.
+
+    Every record has the same layout, so the records are assembled as one
+    byte array with the headers broadcast and the values copied in as
+    little-endian float32, rather than serialized one message at a time.
+    """
+    rows = np.asarray(rows)
+    n_features = rows.shape[1] - 1
+    features_header = _dense_tensor_entry(1, 4 * n_features)
+    label_header = _dense_tensor_entry(2, 4)
+    size = len(features_header) + 4 * n_features + len(label_header) + 4
+    padding = -size % 4
+    layout = [
+        struct.pack("<II", 0xCED7230A, size) + features_header,
+        rows[:, 1:],
+        label_header,
+        rows[:, :1],
+        bytes(padding),
+    ]
+
+    records = np.empty((len(rows), 8 + size + padding), dtype=np.uint8)
+    offset = 0
+    for part in layout:
+        if isinstance(part, bytes):
+            records[:, offset:offset + len(part)] = np.frombuffer(part, dtype=np.uint8)
+            offset += len(part)
+        else:
+            values = np.ascontiguousarray(part, dtype="<f4").view(np.uint8)
+            records[:, offset:offset + values.shape[1]] = values
+            offset += values.shape[1]
+    return records.tobytes()
+
+class SplitFile:
+    """Appends rows to one split output file in one of the output_formats."""
+
+    def __init__(self, path, output_format="csv") -> None:
+        self.path = path
+        self._format = output_format
+        self._file = open(path, "w" if output_format == "csv" else "wb")
+        self._parquet_writer = None
+        self._dtype = None
+        self.rows = 0
+        self.columns = 0
+        if output_format == "npy":
+            self._file.write(_npy_header((0, 0), np.float64))
+
+    def write(self, rows):
+        self.rows += len(rows)
+        self.columns = rows.shape[1]
+        if self._format == "csv":
+            pd.DataFrame(rows).to_csv(self._file, header=False, index=False)
+        elif self._format == "npy":
+            if self._dtype is None:
+                self._dtype = rows.dtype
+            np.ascontiguousarray(rows, dtype=self._dtype).tofile(self._file)
+        elif self._format == "recordio":
+            self._file.write(encode_recordio_protobuf(rows))
+        elif self._format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            table = pa.table({str(column): rows[:, column] for column in range(rows.shape[1])})
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self._file, table.schema)
+            self._parquet_writer.write_table(table)
+        else:
+            raise ValueError(f"Unsupported output format {self._format}")
+
+    def close(self):
+        if self._format == "npy":
+            self._file.seek(0)
+            dtype = np.float64 if self._dtype is None else self._dtype
+            self._file.write(_npy_header((self.rows, self.columns), dtype))
+        elif self._format == "parquet":
+            if self._parquet_writer is None:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                self._parquet_writer = pq.ParquetWriter(self._file, pa.schema([]))
+            self._parquet_writer.close()
+        self._file.close()
+
+def split_path(base_dir, name, output_format="csv", part=None, shard=None):
+    """Returns the path of a split's output, of one host's part of it, or of one shard."""
+    if shard is not None:
+        file_name = f"part-{shard:05d}"
+    else:
+        file_name = name if part is None else f"{name}-{part:05d}"
+    return os.path.join(base_dir, name, file_name + output_formats[output_format])
+
+def process_in_chunks(
+    data_builder,
+    base_dir,
+    *,
+    median_rank_error=None,
+    previous_source_statistics=None,
+    splitter=None,
+    shuffle_buckets=0,
+    low_memory=False,
+    transform_workers=1,
+    output_format="csv",
+    test_format=None,
+    rendezvous=None,
+    shards=0,
+    profile_uri=None,
+    checkpoint=None,
+):
+    """Fits and applies the transforms without holding the whole dataset in memory.
+
+    Every chunk of raw data is folded into the fit statistics and spilled to
+    local disk as it arrives. The statistics of a source found in
+    previous_source_statistics are reused instead of being recomputed. The
+    transforms are then fitted from the merged statistics, and the spilled
+    chunks are transformed, split and written to the outputs one at a time.
+
+    With a Rendezvous, the data builder only yields this host's shard of the
+    manifest: the partial statistics of all hosts are exchanged and merged
+    in rank order, so every host fits the same transforms, and each host
+    writes its own part of the splits. The data profile, gathered in the
+    same pass as the statistics, is written to profile_uri if given.
+
+    The ingest, fit, transform and split stages each leave their outputs in
+    a local directory. With a Checkpoint, these are saved as each stage
+    completes, and a stage already complete is skipped, its outputs restored
+    only if a later stage still has to run or they are outputs of the job.
+    The ingest stage saves the deduplication index of the data builder, if
+    any, and the rows it dropped to {base_dir}/dedup, for the caller to save
+    once the job's outputs are complete.
+
+    Returns the fitted DataProcessor and the statistics of every versioned
+    source, keyed by source_key, for the next run to reuse.
+    """
+    logger = logging.getLogger(__name__)
+    chunk_dir = os.path.join(base_dir, "chunks")
+    dedup_dir = os.path.join(base_dir, "dedup")
+    fit_dir = os.path.join(base_dir, "stages", "fit")
+    transform_dir = os.path.join(base_dir, "stages", "transform")
+    stage_paths = {
+        "ingest": {"chunks": chunk_dir, "dedup": dedup_dir},
+        "fit": {"fit": fit_dir},
+        "transform": {"transform": transform_dir},
+        "split": {name: os.path.join(base_dir, name) for name in split_names + ["index"]},
+    }
+    stage_inputs = {
+        "fit": ["ingest"],
+        "transform": ["ingest", "fit"],
+        "split": ["ingest", "transform"],
+    }
+    completed = {
+        stage for stage in stage_paths if checkpoint is not None and checkpoint.done(stage)
+    }
+    # The fitted transforms and the splits are outputs of the job.
+    needed = {"fit", "split"}
+    for stage in stage_paths:
+        if stage not in completed:
+            needed.update(stage_inputs.get(stage, []))
+    for stage in stage_paths:
+        if stage in completed and stage in needed:
+            checkpoint.restore(stage, stage_paths[stage])
+    if "ingest" in completed and "ingest" not in needed and data_builder.dedup is not None:
+        checkpoint.restore("ingest", {"dedup": dedup_dir})
+    part = rendezvous.rank if rendezvous is not None else None
+    splitter = splitter or DatasetSplitter()
+
+    def run_stage(stage, fn):
+        if stage in completed:
+            logger.info("Skipping stage %s, completed by a previous run.", stage)
+            return None
+        with stage_profiler.stage(stage):
+            result = fn()
+        if checkpoint is not None:
+            checkpoint.save(stage, stage_paths[stage])
+        return result
+
+    def chunk_paths():
+        names = sorted((name for name in os.listdir(chunk_dir) if name.isdigit()), key=int)
+        return [os.path.join(chunk_dir, name) for name in names]
+
+    def ingest():
+        profiler = DataProfiler(median_rank_error, previous_source_statistics, data_builder.dedup)
+        sources = 0
+        for value, chunk in data_builder.iter_sources():
+            profiler.update(value, chunk)
+            write_frame(os.path.join(chunk_dir, str(sources)), chunk)
+            sources += 1
+        logger.info("Reused saved statistics of %d of %d sources.", profiler.reused, sources)
+        write_uri(os.path.join(chunk_dir, "profiler.json"), json.dumps(profiler.to_dict()).encode())
+        dedup = data_builder.dedup
+        if dedup is not None:
+            write_uri(os.path.join(dedup_dir, "index.npz"), dedup.dump())
+            write_uri(os.path.join(dedup_dir, "dropped.json"), json.dumps(dedup.dropped).encode())
+        return profiler
+
+    def fit(profiler):
+        if profiler is None:
+            text = read_uri(os.path.join(chunk_dir, "profiler.json"))
+            profiler = DataProfiler.from_dict(json.loads(text), median_rank_error)
+        if rendezvous is not None:
+            os.makedirs(fit_dir, exist_ok=True)
+            # Kept for runs that skip this stage, as the other hosts still wait for them.
+            write_uri(
+                os.path.join(fit_dir, "profiler.json"), json.dumps(profiler.to_dict()).encode()
+            )
+            logger.info(
+                "Merging statistics of %d rows with the other %d hosts.",
+                profiler.statistics.rows,
+                rendezvous.hosts - 1,
+            )
+            profiler.gather(rendezvous)
+        statistics = profiler.statistics
+        paths = chunk_paths()
+        logger.info("Fitting transforms from %d rows in %d chunks.", statistics.rows, len(paths))
+        # The transforms are laid out on the first chunk with rows, if any.
+        sample = next((df for df in map(read_frame, paths) if len(df)), None)
+        data_processor = DataProcessor.from_statistics(
+            statistics, sample, low_memory, transform_workers
+        )
+        os.makedirs(fit_dir, exist_ok=True)
+        data_processor.save_model(fit_dir)
+        text = dump_source_statistics(profiler.source_statistics, median_rank_error)
+        write_uri(os.path.join(fit_dir, "statistics.json"), text.encode())
+        write_uri(
+            os.path.join(fit_dir, "data_profile.json"),
+            json.dumps(profiler.profile(), indent=2).encode(),
+        )
+        return data_processor, profiler.source_statistics
+
+    def transform():
+        logger.info("Transforming the chunks in %s.", chunk_dir)
+        os.makedirs(transform_dir, exist_ok=True)
+        try:
+            for chunk_path in chunk_paths():
+                data_output = data_processor.process_chunk(read_frame(chunk_path))
+                output_path = os.path.join(transform_dir, os.path.basename(chunk_path) + ".npy")
+                np.save(output_path, data_output)
+        finally:
+            data_processor.close()
+
+    def split():
+        logger.info("Writing out datasets to %s.", base_dir)
+        writer = SplitWriter(
+            base_dir, shuffle_buckets, splitter.seed, output_format, test_format, part, shards
+        )
+        try:
+            for chunk_path in chunk_paths():
+                output_path = os.path.join(transform_dir, os.path.basename(chunk_path) + ".npy")
+                with stage_profiler.stage("shuffle"):
+                    splits = splitter.split(np.load(output_path), read_frame(chunk_path))
+                with stage_profiler.stage("write"):
+                    for name, rows in zip(split_names, splits):
+                        writer.write(name, rows)
+                shutil.rmtree(chunk_path)
+                os.remove(output_path)
+        finally:
+            with stage_profiler.stage("write"):
+                writer.close()
+        logger.info("Wrote %s rows.", writer.rows)
+
+    profiler = run_stage("ingest", ingest)
+    fitted = run_stage("fit", lambda: fit(profiler))
+    if fitted is not None:
+        data_processor, source_statistics = fitted
+    else:
+        if rendezvous is not None:
+            # The other hosts may be fitting again, as each checkpoints under its own key.
+            rendezvous.publish("statistics", read_uri(os.path.join(fit_dir, "profiler.json")))
+        data_processor = DataProcessor.load(fit_dir, low_memory, transform_workers)
+        text = read_uri(os.path.join(fit_dir, "statistics.json")).decode()
+        source_statistics = load_source_statistics(text, median_rank_error)
+    run_stage("transform", transform)
+    run_stage("split", split)
+
+    if profile_uri and part in (None, 0):
+        logger.info("Writing the data profile to %s.", profile_uri)
+        write_uri(profile_uri, read_uri(os.path.join(fit_dir, "data_profile.json")))
+    shutil.rmtree(chunk_dir, ignore_errors=True)
+    shutil.rmtree(os.path.join(base_dir, "stages"), ignore_errors=True)
+
+    return data_processor, source_statistics
 
 def run_main():
     logger = logging.getLogger()
@@ -162,34 +2502,247 @@ def run_main():
     logger.debug("Starting preprocessing.")
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--data-manifest", type=str, required=True)
+    manifest_group = parser.add_mutually_exclusive_group(required=True)
+    manifest_group.add_argument("--data-manifest", type=str)
+    manifest_group.add_argument("--data-manifest-file", type=str)
+    parser.add_argument("--download-concurrency", type=int, default=1)
+    parser.add_argument("--multipart-threshold", type=int, default=None)
+    parser.add_argument("--multipart-concurrency", type=int, default=8)
+    parser.add_argument("--cache-dir", type=str, default=None)
+    parser.add_argument("--cache-max-bytes", type=int, default=None)
+    parser.add_argument("--chunked", action="store_true")
+    parser.add_argument("--median-rank-error", type=float, default=None)
+    parser.add_argument("--statistics-uri", type=str, default=None)
+    parser.add_argument("--split-mode", choices=["shuffle", "hash"], default="shuffle")
+    parser.add_argument("--split-ratios", type=str, default="0.7,0.15,0.15")
+    parser.add_argument("--split-seed", type=int, default=None)
+    parser.add_argument("--shuffle-buckets", type=int, default=0)
+    parser.add_argument("--low-memory", action="store_true")
+    parser.add_argument("--transform-workers", type=int, default=1)
+    parser.add_argument("--output-format", choices=list(output_formats), default="csv")
+    parser.add_argument("--test-format", choices=list(output_formats), default=None)
+    parser.add_argument("--shards", type=int, default=0)
+    parser.add_argument("--data-profile", action="store_true")
+    parser.add_argument("--dedup-index", type=str, default=None)
+    parser.add_argument("--sample", type=str, default=None)
+    parser.add_argument("--sample-seed", type=int, default=None)
+    parser.add_argument("--sample-stratify", action="store_true")
+    parser.add_argument("--rendezvous-uri", type=str, default=None)
+    parser.add_argument("--rendezvous-timeout", type=int, default=3600)
+    parser.add_argument("--checkpoint-uri", type=str, default=None)
+    parser.add_argument("--base-dir", type=str, default="/opt/ml/processing")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--cprofile", action="store_true")
     args = parser.parse_args()
+    if args.profile:
+        stage_profiler.start(cprofile=args.cprofile)
+
+    try:
+        sample = parse_sample(args.sample)
+    except ValueError as e:
+        parser.error(str(e))
+
+    rank, hosts = host_rank()
+    rendezvous = None
+    if hosts > 1:
+        if not args.chunked or not args.rendezvous_uri:
+            parser.error("Preprocessing on several hosts requires --chunked and --rendezvous-uri")
+        if args.dedup_index:
+            parser.error("--dedup-index is not supported on several hosts")
+        logger.info("Preprocessing shard %d of %d.", rank, hosts)
+        rendezvous = Rendezvous(args.rendezvous_uri, rank, hosts, args.rendezvous_timeout)
+
+    checkpoint = None
+    if args.checkpoint_uri:
+        if not args.chunked:
+            parser.error("--checkpoint-uri requires --chunked")
+        if args.data_manifest_file:
+            with open(args.data_manifest_file, "rb") as f:
+                manifest = f.read()
+        else:
+            manifest = args.data_manifest.encode()
+        with open(__file__, "rb") as f:
+            code = f.read()
+        # Arguments that only tune how a run goes do not change its outputs.
+        arguments = {
+            name: value
+            for name, value in vars(args).items()
+            if name not in checkpoint_ignored_arguments
+        }
+        # The saved dedup index and statistics change what a run ingests.
+        saved = [read_uri(uri) or b"" for uri in (args.dedup_index, args.statistics_uri) if uri]
+        key = fingerprint(manifest, code, arguments, [rank, hosts], *saved)
+        logger.info("Checkpointing the stages under %s/%s.", args.checkpoint_uri, key)
+        checkpoint = Checkpoint(args.checkpoint_uri, key)
 
     logger.debug("Downloading raw input data")
-    base_dir = "/opt/ml/processing"
-    data_builder = DataBuilder(base_dir, args.data_manifest)
-    df = data_builder.build()
-
-    logger.debug("Preprocessing raw input data")
-    data_processor = DataProcessor(df)
-    data_output = data_processor.process()
-
-    len_data_output = len(data_output)
-    logger.info("Splitting %d rows of data into train, validation, test datasets.", len_data_output)
-    np.random.shuffle(data_output)
-    train, validation, test = np.split(
-        data_output, [int(0.7 * len_data_output), int(0.85 * len_data_output)]
+    base_dir = args.base_dir
+    dedup = DedupIndex(args.dedup_index) if args.dedup_index else None
+    sampler = None
+    if sample is not None:
+        logger.info("Sampling the raw input data: fraction %s, count %s.", *sample)
+        if args.sample_stratify and sample[0] is not None:
+            logger.info("A fraction is sampled uniformly; only a count is stratified.")
+        fraction, count = sample
+        if count is not None and hosts > 1:
+            if count < hosts:
+                parser.error(f"--sample {count} must be at least the number of hosts, {hosts}")
+            # Every host samples its own shard, so each takes its part of the count.
+            count = host_share(count, rank, hosts)
+            logger.info("Sampling %d rows of this host's shard.", count)
+        sampler = RowSampler(fraction, count, seed=args.sample_seed, stratify=args.sample_stratify)
+    data_builder = DataBuilder(
+        base_dir,
+        args.data_manifest,
+        data_manifest_file=args.data_manifest_file,
+        concurrency=args.download_concurrency,
+        multipart_threshold=args.multipart_threshold,
+        multipart_concurrency=args.multipart_concurrency,
+        cache=IngestCache(args.cache_dir, args.cache_max_bytes) if args.cache_dir else None,
+        low_memory=args.low_memory,
+        rank=rank,
+        hosts=hosts,
+        dedup=dedup,
+        sampler=sampler,
     )
 
-    logger.info("Writing out datasets to %s.", base_dir)
-    pd.DataFrame(train).to_csv(f"{base_dir}/train/train.csv", header=False, index=False)
-    pd.DataFrame(validation).to_csv(
-        f"{base_dir}/validation/validation.csv", header=False, index=False
+    splitter = DatasetSplitter(
+        args.split_mode,
+        [float(ratio) for ratio in args.split_ratios.split(",")],
+        args.split_seed,
     )
-    pd.DataFrame(test).to_csv(f"{base_dir}/test/test.csv", header=False, index=False)
 
-    logger.info("Saving the preprocessing model to %s", base_dir)
-    data_processor.save_model(os.path.join(base_dir, "model"))
+    profile_path = os.path.join(base_dir, "profile", "data_profile.json")
+    source_statistics = None
+    if args.chunked:
+        logger.debug("Preprocessing raw input data in chunks")
+        previous_source_statistics = None
+        # The statistics of a sample are not those of its sources.
+        statistics_uri = args.statistics_uri if sampler is None else None
+        if statistics_uri:
+            text = read_uri(statistics_uri)
+            if text is not None:
+                previous_source_statistics = load_source_statistics(text, args.median_rank_error)
+        data_processor, source_statistics = process_in_chunks(
+            data_builder,
+            base_dir,
+            median_rank_error=args.median_rank_error,
+            previous_source_statistics=previous_source_statistics,
+            splitter=splitter,
+            shuffle_buckets=args.shuffle_buckets,
+            low_memory=args.low_memory,
+            transform_workers=args.transform_workers,
+            output_format=args.output_format,
+            test_format=args.test_format,
+            rendezvous=rendezvous,
+            shards=args.shards,
+            profile_uri=profile_path if args.data_profile else None,
+            checkpoint=checkpoint,
+        )
+    else:
+        if args.data_profile:
+            logger.debug("Profiling raw input data")
+            profiler = DataProfiler(args.median_rank_error)
+            frames = []
+            with stage_profiler.stage("ingest"):
+                for value, chunk in data_builder.iter_sources():
+                    profiler.update(value, chunk)
+                    frames.append(chunk)
+                df = concat_frames(frames)
+            write_uri(profile_path, json.dumps(profiler.profile(), indent=2).encode())
+
+            # The profile already holds the fit statistics, so the data is
+            # only passed over again to transform it.
+            logger.debug("Preprocessing raw input data")
+            with stage_profiler.stage("fit"):
+                sample = next((frame for frame in frames if len(frame)), None)
+                data_processor = DataProcessor.from_statistics(
+                    profiler.statistics, sample, args.low_memory, args.transform_workers
+                )
+            with stage_profiler.stage("transform"):
+                data_output = data_processor.process_chunk(df)
+                data_processor.close()
+        else:
+            with stage_profiler.stage("ingest"):
+                df = data_builder.build()
+
+            logger.debug("Preprocessing raw input data")
+            with stage_profiler.stage("fit"):
+                data_processor = DataProcessor(
+                    df, low_memory=args.low_memory, workers=args.transform_workers
+                )
+            with stage_profiler.stage("transform"):
+                data_output = data_processor.process()
+                data_processor.close()
+
+        logger.info("Splitting %d rows of data into train, validation, test datasets.", len(data_output))
+        with stage_profiler.stage("shuffle"):
+            train, validation, test = splitter.split(data_output, df)
+            if args.split_mode == "hash" and args.shuffle_buckets:
+                rng = np.random.default_rng(args.split_seed)
+                for split in (train, validation, test):
+                    rng.shuffle(split)
+
+        logger.info("Writing out datasets to %s.", base_dir)
+        with stage_profiler.stage("write"):
+            writer = SplitWriter(
+                base_dir,
+                output_format=args.output_format,
+                test_format=args.test_format,
+                shards=args.shards,
+            )
+            for name, rows in zip(split_names, (train, validation, test)):
+                writer.write(name, rows)
+            writer.close()
+
+    model_dir = os.path.join(base_dir, "model")
+    if rank == 0 and checkpoint is not None and checkpoint.done("model"):
+        checkpoint.restore("model", {"model": model_dir})
+    elif rank == 0:
+        if source_statistics is not None:
+            logger.info("Saving the per-source statistics to %s", base_dir)
+            text = dump_source_statistics(source_statistics, args.median_rank_error).encode()
+            write_uri(os.path.join(model_dir, "statistics.json"), text)
+        # The other hosts fitted the same transforms, and all hosts upload
+        # to the same model output.
+        logger.info("Saving the preprocessing model to %s", base_dir)
+        with stage_profiler.stage("model_save"):
+            data_processor.save_model(model_dir)
+        if checkpoint is not None:
+            checkpoint.save("model", {"model": model_dir})
+
+    # The saved statistics and dedup index are part of the checkpoint
+    # fingerprint, so they are only replaced once every stage is checkpointed.
+    # The statistics and the dedup index of a sample are not those of its sources.
+    if rank == 0 and args.statistics_uri and sampler is None and source_statistics is not None:
+        logger.info("Saving the per-source statistics to %s", args.statistics_uri)
+        write_uri(args.statistics_uri, read_uri(os.path.join(model_dir, "statistics.json")))
+    if dedup is not None:
+        if args.chunked:
+            dedup_dir = os.path.join(base_dir, "dedup")
+            index = read_uri(os.path.join(dedup_dir, "index.npz"))
+            dropped = json.loads(read_uri(os.path.join(dedup_dir, "dropped.json")))
+        else:
+            index, dropped = dedup.dump(), dedup.dropped
+        if sampler is None:
+            logger.info("Saving the deduplication index to %s", args.dedup_index)
+            write_uri(args.dedup_index, index)
+        write_uri(
+            os.path.join(base_dir, "profile", "dedup_report.json"),
+            json.dumps({"dropped": dropped, "total": sum(dropped.values())}).encode(),
+        )
+
+    if checkpoint is not None:
+        checkpoint.clear()
+
+    logger.info(
+        "Peak resident memory: %.1f MiB",
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    )
+    if args.profile:
+        name = "profile.json" if hosts == 1 else f"profile-{rank:05d}.json"
+        logger.info("Writing the stage profile to %s.", name)
+        stage_profiler.write(os.path.join(base_dir, "profile", name))
 
 if __name__ == "__main__":
     run_main()
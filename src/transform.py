@@ -15,20 +15,24 @@
 
 import pandas as pd
 import joblib
+import io
+import json
 from io import StringIO
 import os
+import struct
 import numpy as np
 import logging
 
-from sagemaker_containers.beta.framework import (
-    encoders, worker)
-
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 XGBOOST_CONTENT_TYPE='text/csv'
 
+# Response content types output_fn can encode, for the accept of the XGBoost container.
+RECORDIO_CONTENT_TYPE='application/x-recordio-protobuf'
+LIBSVM_CONTENT_TYPE='text/libsvm'
+
 feature_columns_names = [
     "sex",
     "length",
@@ -42,16 +46,223 @@ feature_columns_names = [
 
 label_column = "rings"
 
+categorical_columns_names = ["sex"]
+
+# Values pandas reads as missing by default.
+missing_values = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+}
+
+# Above this many rows, pandas' C parser is faster than splitting rows in Python.
+fast_csv_max_rows = 256
+
+def _parse_numbers(name, values):
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        pass
+    numbers = np.empty(len(values))
+    for index, value in enumerate(values):
+        if value is None or isinstance(value, str) and value.strip() in missing_values:
+            numbers[index] = np.nan
+            continue
+        try:
+            numbers[index] = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Row {index + 1}: {name} {value!r} is not a number") from None
+    return numbers
+
+def _column_names(widths):
+    """Returns the columns of rows of the given widths, which must all be labelled or not."""
+    if not len(widths):
+        raise ValueError("No rows in input")
+    width = widths[0]
+    if width not in (len(feature_columns_names), len(feature_columns_names) + 1):
+        raise ValueError(
+            f"Row 1 has {width} fields, not {len(feature_columns_names)} features "
+            "optionally followed by the label"
+        )
+    for index, row_width in enumerate(widths):
+        if row_width != width:
+            raise ValueError(
+                f"Row {index + 1} has {row_width} fields, not {width} like row 1; "
+                "labelled and unlabelled rows cannot be mixed in one request"
+            )
+    return (feature_columns_names + [label_column])[:width]
+
+def _structured(names, columns):
+    """Builds the structured array of the named columns, each a sequence of raw values."""
+    dtype = [
+        (name, object if name in categorical_columns_names else np.float64) for name in names
+    ]
+    data = np.empty(len(columns[0]), dtype=dtype)
+    for name, values in zip(names, columns):
+        if name in categorical_columns_names:
+            data[name] = [
+                np.nan if value is None or value in missing_values else value for value in values
+            ]
+        else:
+            data[name] = _parse_numbers(name, values)
+    return data
+
+def parse_csv(text):
+    """Parses CSV rows of the abalone layout, labelled or not, into a structured array.
+
+    Returns None for input with quoted fields, or more than fast_csv_max_rows
+    rows once their widths are checked, which is left to pandas. Raises
+    ValueError for rows without the 8 feature fields, or 9 with the label,
+    of the first row, or with numeric fields that are not numbers.
+    """
+    if '"' in text:
+        return None
+    lines = [line for line in text.splitlines() if line.strip()]
+    names = _column_names([line.count(",") + 1 for line in lines])
+    if len(lines) > fast_csv_max_rows:
+        return None
+    return _structured(names, list(zip(*(line.split(",") for line in lines))))
+
+def parse_jsonlines(text):
+    """Parses JSON Lines of rows into a structured array.
+
+    Every line holds either an array of the 8 or 9 CSV fields, or an object
+    of the features, and the label if labelled, by column name; null values
+    are missing.
+    """
+    records = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if records and isinstance(records[0], dict):
+        labelled = label_column in records[0]
+        for index, record in enumerate(records):
+            if not isinstance(record, dict):
+                raise ValueError(f"Row {index + 1} is not an object like row 1")
+            if (label_column in record) != labelled:
+                raise ValueError(
+                    f"Row {index + 1} is {'un' if labelled else ''}labelled, unlike row 1; "
+                    "labelled and unlabelled rows cannot be mixed in one request"
+                )
+            missing = [name for name in feature_columns_names if name not in record]
+            if missing:
+                raise ValueError(f"Row {index + 1} lacks {', '.join(missing)}")
+        names = feature_columns_names + [label_column] if labelled else feature_columns_names
+        return _structured(names, [[record[name] for record in records] for name in names])
+
+    for index, record in enumerate(records):
+        if not isinstance(record, list):
+            raise ValueError(f"Row {index + 1} is neither an object nor an array")
+    names = _column_names([len(record) for record in records])
+    return _structured(names, list(zip(*records)))
+
+def parse_npy(data):
+    """Parses an .npy array of rows into a structured array.
+
+    The array is either structured, with a field per column, the label
+    field included if labelled, or two-dimensional with the 8 or 9 CSV
+    fields of each row as its columns, typically strings.
+    """
+    array = np.load(io.BytesIO(data), allow_pickle=False)
+    if array.dtype.names:
+        missing = [name for name in feature_columns_names if name not in array.dtype.names]
+        if missing:
+            raise ValueError(f"The array has no {', '.join(missing)} field")
+        names = feature_columns_names + [label_column]
+        names = [name for name in names if name in array.dtype.names]
+        return _structured(names, [array[name] for name in names])
+    if array.ndim == 1:
+        array = array.reshape(1, -1)
+    if array.ndim != 2:
+        raise ValueError(f"The array has {array.ndim} dimensions, not 2")
+    names = _column_names([array.shape[1]] * len(array))
+    return _structured(names, list(array.T))
+
+class CompiledPreprocessor:
+    """The fitted preprocessing transforms, applied with NumPy alone.
+
+    Loaded from the compiled arrays that preprocess.py saves along with
+    model.joblib, it gives the same output as the joblib ColumnTransformer
+    without building its pandas and sklearn intermediates for every request.
+    """
+
+    def __init__(self, arrays):
+        self.numeric_columns = [str(column) for column in arrays["numeric_columns"]]
+        self.medians = arrays["medians"]
+        self.means = arrays["means"]
+        self.scales = arrays["scales"]
+        self.categorical_columns = [str(column) for column in arrays["categorical_columns"]]
+        self.missing_category = str(arrays["missing_category"])
+        self.categories = arrays["categories"]
+        self.category_offsets = arrays["category_offsets"]
+
+    @classmethod
+    def load(cls, path):
+        """Loads compiled.npy, memory-mapped.
+
+        The arrays are views of the mapped compiled.npy at the offsets listed
+        in compiled.json, so the serving workers share its pages and loading
+        reads no more than the headers.
+        """
+        with open(path[:-len(".npy")] + ".json") as f:
+            index = json.load(f)
+        # Plain ndarray views of the mapping are much cheaper to slice than np.memmap.
+        data = np.load(path, mmap_mode="r").view(np.ndarray)
+        return cls({
+            name: data[entry["offset"]:entry["offset"] + entry["size"]]
+            .view(entry["dtype"])
+            .reshape(entry["shape"])
+            for name, entry in index.items()
+        })
+
+    def transform(self, input_data):
+        """Transforms the columns of input_data, a DataFrame or a structured array."""
+        rows = len(input_data)
+        numeric_count = len(self.numeric_columns)
+        output = np.zeros((rows, numeric_count + len(self.categories)))
+
+        numeric = output[:, :numeric_count]
+        for index, column in enumerate(self.numeric_columns):
+            numeric[:, index] = input_data[column]
+        np.copyto(numeric, self.medians, where=np.isnan(numeric))
+        numeric -= self.means
+        numeric /= self.scales
+
+        for index, column in enumerate(self.categorical_columns):
+            start, end = self.category_offsets[index], self.category_offsets[index + 1]
+            if start == end:
+                continue
+            categories = self.categories[start:end]
+            values = np.asarray(input_data[column], dtype=object)
+            # Missing values are NaN, the only value not equal to itself.
+            values = np.where(values != values, self.missing_category, values).astype(str)
+            positions = np.minimum(np.searchsorted(categories, values), len(categories) - 1)
+            # Categories not seen in fitting are left all zeros.
+            found = categories[positions] == values
+            output[np.flatnonzero(found), numeric_count + start + positions[found]] = 1.0
+
+        return output
+
 def input_fn(input_data, content_type):
     """Parse input data payload
 
-    We currently only take csv input. Since we need to process both labelled
-    and unlabelled data we first determine whether the label column is present
-    by looking at how many columns were provided.
+    We take a batch of rows as csv, JSON Lines or an .npy array. Since we
+    need to process both labelled and unlabelled data we first determine
+    whether the label column is present by looking at how many columns were
+    provided; every row of a batch must agree.
+
+    Rows are parsed straight into a structured array; csv input with quoted
+    fields or many rows is read by pandas into a DataFrame instead.
     """
-    logger.info(f"input data {input_data} with format {content_type}")
+    logger.info(f"input data of {len(input_data)} bytes with format {content_type}")
 
+    if content_type == 'application/x-npy':
+        return parse_npy(input_data)
+    if isinstance(input_data, bytes):
+        input_data = input_data.decode("utf-8")
+    if content_type in ('application/jsonlines', 'application/x-jsonlines'):
+        return parse_jsonlines(input_data)
     if content_type == 'text/csv':
+        data = parse_csv(input_data)
+        if data is not None:
+            return data
+
         # Read the raw input data as CSV.
         df = pd.read_csv(StringIO(input_data), 
                          header=None)
@@ -67,27 +278,91 @@ def input_fn(input_data, content_type):
     else:
         raise ValueError("{} not supported by script!".format(content_type))
 
+def _varint(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append(value & 0x7F | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def _length_delimited(field, size):
+    return _varint(field << 3 | 2) + _varint(size)
+
+def encode_recordio_protobuf(rows):
+    """Encodes rows as dense float32 RecordIO-protobuf records of their features.
+
+    The same encoding as preprocess.py writes for training, without the
+    label: the headers are the same for every record, so the records are
+    assembled as one byte array with the values copied in.
+    """
+    rows = np.asarray(rows)
+    size = 4 * rows.shape[1]
+    tensor = _length_delimited(1, size)
+    value = _length_delimited(2, len(tensor) + size) + tensor
+    entry = _length_delimited(1, 6) + b"values" + _length_delimited(2, len(value) + size) + value
+    header = _length_delimited(1, len(entry) + size) + entry
+    padding = -(len(header) + size) % 4
+    header = struct.pack("<II", 0xCED7230A, len(header) + size) + header
+
+    records = np.zeros((len(rows), len(header) + size + padding), dtype=np.uint8)
+    records[:, :len(header)] = np.frombuffer(header, dtype=np.uint8)
+    records[:, len(header):len(header) + size] = (
+        np.ascontiguousarray(rows, dtype="<f4").view(np.uint8).reshape(len(rows), size)
+    )
+    return records.tobytes()
+
+def encode_libsvm(rows):
+    """Encodes rows as libsvm lines of zero-based feature indices, with a 0 label.
+
+    Zero values, most of the one-hot columns, are written too: XGBoost reads
+    an absent entry as missing, unlike the dense data the model is trained on.
+    """
+    rows = np.asarray(rows, dtype=np.float32)
+    buffer = StringIO()
+    fmt = ["0 0:%.9g"] + [f"{index}:%.9g" for index in range(1, rows.shape[1])]
+    np.savetxt(buffer, rows, fmt=fmt, delimiter=" ")
+    return buffer.getvalue()
+
 def output_fn(prediction, accept):
     """Format prediction output.
-       XGBoost only support text/csv and text/libsvm. Use text/csv here. 
+       XGBoost reads text/csv, text/libsvm and application/x-recordio-protobuf. The
+       accept of the request picks one, text/csv for any other.
     """
-    logger.info(f"output data {prediction}")
+    logger.info(f"output data of shape {np.shape(prediction)} as {accept}")
+
+    # Only installed in the serving container.
+    from sagemaker_containers.beta.framework import encoders, worker
 
+    if accept == RECORDIO_CONTENT_TYPE:
+        return worker.Response(encode_recordio_protobuf(prediction), accept, mimetype=accept)
+    if accept == LIBSVM_CONTENT_TYPE:
+        return worker.Response(encode_libsvm(prediction), accept, mimetype=accept)
     return worker.Response(encoders.encode(prediction, XGBOOST_CONTENT_TYPE), XGBOOST_CONTENT_TYPE, mimetype=XGBOOST_CONTENT_TYPE)
 
 def predict_fn(input_data, model):
     """Preprocess input data
 
     We implement this because the default predict_fn uses .predict(), but our model is a preprocessor
-    so we want to use .transform().
+    so we want to use .transform(). The model is either the CompiledPreprocessor, applied with a few
+    NumPy operations, or the joblib ColumnTransformer of models saved without it; both give the
+    same output.
 
     The output is returned in the following order:
 
         rest of features either one hot encoded or standardized
     """
+    if isinstance(input_data, np.ndarray):
+        labelled = label_column in input_data.dtype.names
+        if not isinstance(model, CompiledPreprocessor):
+            # The sklearn pipeline selects its columns by name from a DataFrame.
+            input_data = pd.DataFrame(input_data)
+    else:
+        labelled = label_column in input_data
+
     features = model.transform(input_data)
 
-    if label_column in input_data:
+    if labelled:
         # Return the label (as the first column) and the set of features.
         return np.insert(features, 0, input_data[label_column], axis=1)
     else:
@@ -96,7 +371,12 @@ def predict_fn(input_data, model):
 
 def model_fn(model_dir):
     """Deserialize fitted model
+
+    The compiled preprocessor is preferred when the model was saved with one;
+    otherwise the arrays of model.joblib are memory-mapped.
     """
-    preprocessor = joblib.load(os.path.join(model_dir, "model.joblib"))
+    compiled_path = os.path.join(model_dir, "compiled.npy")
+    if os.path.exists(compiled_path):
+        return CompiledPreprocessor.load(compiled_path)
+    preprocessor = joblib.load(os.path.join(model_dir, "model.joblib"), mmap_mode="r")
     return preprocessor
-  
\ No newline at end of file
@@ -0,0 +1,71 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                                                              *
+
+"""Microbenchmark of transform.py request parsing, against the pandas path it replaces.
+
+Run with PYTHONPATH=src python tests/bench_transform.py; it is not collected
+by pytest.
+"""
+import io
+import logging
+import os
+import tempfile
+import timeit
+
+import joblib
+import pandas as pd
+
+from preprocess import DataProcessor, feature_columns_names, label_column
+from transform import input_fn, model_fn, predict_fn
+from test_preprocess import make_raw_frame
+
+def pandas_input_fn(payload):
+    """The input_fn parsing before the fast parser."""
+    df = pd.read_csv(io.StringIO(payload), header=None)
+    df.columns = feature_columns_names[:len(df.columns)] + [label_column][:len(df.columns) - 8]
+    return df
+
+def bench(name, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print(f"{name:<40} {seconds * 1e6:>12.1f} us", flush=True)
+
+def main():
+    logging.getLogger().setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as model_dir:
+        DataProcessor(make_raw_frame(1000)).save_model(model_dir)
+        compiled = model_fn(model_dir)
+        pipeline = joblib.load(os.path.join(model_dir, "model.joblib"))
+
+    for rows in (1, 10, 1000):
+        payload = make_raw_frame(rows, seed=1).drop(columns=[label_column]).to_csv(
+            header=False, index=False
+        )
+        number = max(5, 1000 // rows)
+        print(f"{rows} rows:")
+        bench("parse: pandas", lambda: pandas_input_fn(payload), number)
+        bench("parse: input_fn", lambda: input_fn(payload, "text/csv"), number)
+        bench(
+            "parse + transform: pandas + pipeline",
+            lambda: predict_fn(pandas_input_fn(payload), pipeline),
+            number,
+        )
+        bench(
+            "parse + transform: input_fn + compiled",
+            lambda: predict_fn(input_fn(payload, "text/csv"), compiled),
+            number,
+        )
+
+if __name__ == "__main__":
+    main()
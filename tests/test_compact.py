@@ -0,0 +1,100 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                                                              *
+
+from unittest import TestCase, mock
+import json
+import os
+import pandas as pd
+from compact import compact, encode_manifest, lambda_handler, read_manifest
+from preprocess import DataBuilder
+from test_preprocess import FakeS3Client, make_objects, make_raw_frame
+
+manifest_uri = "s3://manifests/manifest.json.zip"
+
+def make_bucket(df, count, large=()):
+    """Returns a fake client holding df as count CSV objects and a zipped manifest of them."""
+    objects = make_objects(df, count)
+    entries = [
+        {
+            "bucketName": "data",
+            "objectKey": f"{index}.csv",
+            "size": len(objects[("data", f"{index}.csv")]) * (100 if index in large else 1),
+        }
+        for index in range(count)
+    ]
+    objects[("manifests", "manifest.json.zip")] = encode_manifest(manifest_uri, {"data": entries})
+    return FakeS3Client(objects)
+
+def build(s3_client):
+    manifest, _ = read_manifest(manifest_uri, s3_client)
+    df = DataBuilder("/tmp", json.dumps(manifest), s3_client=s3_client).build()
+    return df.reset_index(drop=True)
+
+class TestCompaction(TestCase):
+    def test_small_objects_are_merged_in_manifest_order(self):
+        df = make_raw_frame(800, seed=21)
+        s3_client = make_bucket(df, 8, large=(5,))
+        original = build(s3_client)
+        size = len(s3_client.objects[("data", "0.csv")])
+
+        compacted_uri = "s3://data/compacted"
+        summary = compact(manifest_uri, compacted_uri, 7 * size // 2, 2 * size, 2, s3_client)
+
+        manifest, _ = read_manifest(manifest_uri, s3_client)
+        self.assertEqual(summary, {"merged": 7, "written": 3})
+        self.assertEqual(
+            [[source["objectKey"] for source in entry.get("sources", [entry])]
+             for entry in manifest["data"]],
+            [["0.csv", "1.csv", "2.csv"], ["3.csv", "4.csv"], ["5.csv"], ["6.csv", "7.csv"]],
+        )
+        self.assertTrue(manifest["data"][0]["objectKey"].startswith("compacted/"))
+        self.assertEqual(manifest["data"][0]["rows"], 300)
+        pd.testing.assert_frame_equal(build(s3_client), original)
+
+        # Compacted files are compacted again with the lineage of their sources.
+        summary = compact(manifest_uri, compacted_uri, 1000 * size, 1000 * size, 2, s3_client)
+
+        manifest, _ = read_manifest(manifest_uri, s3_client)
+        self.assertEqual(summary, {"merged": 4, "written": 1})
+        self.assertEqual(len(manifest["data"]), 1)
+        self.assertEqual(
+            [source["objectKey"] for source in manifest["data"][0]["sources"]],
+            [f"{index}.csv" for index in range(8)],
+        )
+        pd.testing.assert_frame_equal(build(s3_client), original)
+
+    def test_manifest_changed_during_compaction_is_kept(self):
+        changed = encode_manifest(manifest_uri, {"data": []})
+
+        class ChangingS3Client(FakeS3Client):
+            def put_object(self, Bucket, Key, Body, IfMatch=None):
+                # A new upload rewrites the manifest while the objects are merged,
+                # or just before the compacted manifest is put.
+                if Key.startswith(self.changed_before):
+                    self.objects[("manifests", "manifest.json.zip")] = changed
+                return super().put_object(Bucket, Key, Body, IfMatch)
+
+        for changed_before in ("compacted/", "manifest.json.zip"):
+            s3_client = ChangingS3Client(make_bucket(make_raw_frame(400, seed=22), 4).objects)
+            s3_client.changed_before = changed_before
+            with self.assertRaises(RuntimeError):
+                compact(manifest_uri, "s3://data/compacted", s3_client=s3_client)
+            self.assertEqual(s3_client.objects[("manifests", "manifest.json.zip")], changed)
+
+    def test_lambda_handler_requires_the_manifest_and_output(self):
+        with mock.patch.dict(os.environ, {"COMPACTED_DATA_URI": "s3://data/compacted"}):
+            os.environ.pop("DATA_MANIFEST_URI", None)
+            with self.assertRaisesRegex(ValueError, "DATA_MANIFEST_URI"):
+                lambda_handler({}, None)
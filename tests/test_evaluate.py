@@ -0,0 +1,127 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                                                              *
+
+from unittest import TestCase
+import os
+import sys
+import tempfile
+import tracemalloc
+import types
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+from preprocess import SplitWriter
+
+# evaluate.py imports xgboost, which is only installed in the evaluation image.
+sys.modules.setdefault("xgboost", types.ModuleType("xgboost"))
+from evaluate import StageTimer, read_test_data
+
+def write_test_split(base_dir, rows, test_format="npy", part=None, shards=0):
+    """Writes rows as the test split of one host, along with its index."""
+    for name in ("train", "validation", "test", "index"):
+        os.makedirs(os.path.join(base_dir, name), exist_ok=True)
+    writer = SplitWriter(base_dir, test_format=test_format, part=part, shards=shards)
+    writer.write("test", rows)
+    writer.close()
+
+def read_parts(test_dir):
+    """Reads every part of the test split, in name order, with numpy and pandas alone."""
+    parts = []
+    for name in sorted(os.listdir(test_dir)):
+        path = os.path.join(test_dir, name)
+        if name.endswith(".npy"):
+            parts.append(np.load(path))
+        elif name.endswith(".parquet"):
+            parts.append(pd.read_parquet(path).to_numpy())
+        elif os.path.getsize(path):
+            parts.append(pd.read_csv(path, header=None).to_numpy())
+    return np.concatenate([part for part in parts if len(part)])
+
+class TestReadTestData(TestCase):
+    def test_parts_of_several_hosts_are_read_into_one_array(self):
+        rng = np.random.default_rng(41)
+        with tempfile.TemporaryDirectory() as base_dir:
+            # Host 1 has a single row, which leaves one of its shards empty.
+            write_test_split(base_dir, rng.normal(size=(30, 11)), part=0, shards=2)
+            write_test_split(base_dir, rng.normal(size=(1, 11)), part=1, shards=2)
+            test_dir = os.path.join(base_dir, "test")
+            index_dir = os.path.join(base_dir, "index")
+            expected = read_parts(test_dir)
+
+            self.assertEqual(expected.shape, (31, 11))
+            np.testing.assert_array_equal(read_test_data(test_dir, index_dir, 3), expected)
+            # Without the index, the parts are read and concatenated.
+            np.testing.assert_array_equal(read_test_data(test_dir, None, 3), expected)
+
+    def test_single_part_stays_memory_mapped(self):
+        rows = np.random.default_rng(42).normal(size=(20, 11))
+        with tempfile.TemporaryDirectory() as base_dir:
+            write_test_split(base_dir, rows, shards=1)
+            test_data = read_test_data(
+                os.path.join(base_dir, "test"), os.path.join(base_dir, "index")
+            )
+            self.assertIsInstance(test_data, np.memmap)
+            np.testing.assert_array_equal(test_data, rows)
+            del test_data
+
+    def test_parts_of_mixed_names_and_formats_are_read_in_name_order(self):
+        rows = np.random.default_rng(43).normal(size=(30, 11))
+        with tempfile.TemporaryDirectory() as base_dir:
+            write_test_split(base_dir, rows[:10], "csv", part=0)
+            write_test_split(base_dir, rows[10:20], "parquet", part=1)
+            write_test_split(base_dir, rows[20:], "npy", part=2, shards=1)
+            test_dir = os.path.join(base_dir, "test")
+            os.remove(os.path.join(base_dir, "index", "test-00002.json"))
+
+            self.assertEqual(
+                sorted(os.listdir(test_dir)),
+                ["part-00002.npy", "test-00000.csv", "test-00001.parquet"],
+            )
+            np.testing.assert_allclose(
+                read_test_data(test_dir, os.path.join(base_dir, "index")),
+                np.concatenate([rows[20:], rows[:10], rows[10:20]]),
+            )
+
+    def test_missing_test_data_is_reported(self):
+        with tempfile.TemporaryDirectory() as base_dir:
+            write_test_split(base_dir, np.empty((0, 11)), part=0, shards=2)
+            with self.assertRaisesRegex(ValueError, "No test data found"):
+                read_test_data(os.path.join(base_dir, "test"), os.path.join(base_dir, "index"))
+
+class TestStageTimer(TestCase):
+    def test_stages_record_time_and_memory(self):
+        timer = StageTimer()
+        with timer.stage("ignored"):
+            pass
+        timer.start()
+        self.addCleanup(tracemalloc.stop)
+        with timer.stage("read"):
+            block = np.ones(1 << 20)
+            del block
+
+            def read_part(_):
+                with timer.stage("read_part"):
+                    return sum(range(10000))
+
+            with ThreadPoolExecutor(2) as executor:
+                list(executor.map(read_part, range(4)))
+
+        stages = timer.stages
+        self.assertEqual(set(stages), {"read", "read_part"})
+        self.assertEqual(stages["read_part"]["calls"], 4)
+        self.assertGreater(stages["read"]["cpu_seconds"], 0)
+        self.assertGreaterEqual(stages["read"]["traced_peak_bytes"], 8 << 20)
+        self.assertGreater(stages["read"]["rss_peak_bytes"], 8 << 20)
+        self.assertNotIn("traced_peak_bytes", stages["read_part"])
@@ -13,11 +13,44 @@
 # IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                                                              *
 
-from unittest import TestCase
+from unittest import TestCase, mock
+import gzip
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import random
+import struct
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+from botocore.exceptions import ClientError
 from preprocess import (
+    Checkpoint,
+    DataBuilder,
+    DataProfiler,
+    DedupIndex,
+    FitStatistics,
+    IngestCache,
     DataProcessor,
+    DatasetSplitter,
+    QuantileSketch,
+    Rendezvous,
+    RowSampler,
+    SplitFile,
+    SplitWriter,
+    StageProfiler,
+    dump_source_statistics,
+    host_share,
+    load_source_statistics,
+    column_dtypes,
+    process_in_chunks,
+    run_main,
+    iter_manifest_entries,
     feature_columns_names,
     label_column,
     feature_columns_dtype,
@@ -47,3 +80,950 @@ class TestPreProcess(TestCase):
         round_output = np.around(output_data, 2)
         np.testing.assert_array_equal(round_output, expected_output)
 
+    def test_fit_from_chunk_statistics_matches_in_memory_fit(self):
+        input_df = make_raw_frame(1000, seed=1)
+        chunks = [input_df.iloc[start:start + 137].copy() for start in range(0, 1000, 137)]
+
+        statistics = FitStatistics()
+        for chunk in chunks:
+            statistics.update(chunk)
+        chunked = DataProcessor.from_statistics(statistics, chunks[0])
+        chunked_output = np.concatenate([chunked.process_chunk(chunk.copy()) for chunk in chunks])
+
+        expected_output = DataProcessor(input_df.copy()).process()
+        np.testing.assert_allclose(chunked_output, expected_output, rtol=1e-12, atol=1e-12)
+
+    def test_sketched_median_is_within_rank_error(self):
+        values = np.random.default_rng(2).lognormal(size=100000)
+        workers = [QuantileSketch(rank_error=0.01, seed=seed) for seed in range(4)]
+        for index, chunk in enumerate(np.array_split(values, 50)):
+            workers[index % 4].update(chunk)
+        sketch = workers[0]
+        for worker in workers[1:]:
+            sketch.merge(worker)
+
+        self.assertEqual(sketch.count, len(values))
+        self.assertLess(sum(len(items) for items in sketch.compactors), 1000)
+        self.assertLess(abs((values < sketch.quantile(0.5)).mean() - 0.5), 0.01)
+
+    def test_parallel_transform_is_identical_to_serial(self):
+        input_df = make_raw_frame(5000, seed=3)
+        low_memory_df = input_df.astype(column_dtypes(low_memory=True))
+        for df, low_memory in ((input_df, False), (low_memory_df, True)):
+            expected_output = DataProcessor(df.copy(), low_memory=low_memory).process()
+            data_processor = DataProcessor(df.copy(), low_memory=low_memory, workers=3)
+            try:
+                output = data_processor.process()
+                chunk_output = data_processor.process_chunk(df.iloc[:1234].copy())
+            finally:
+                data_processor.close()
+            self.assertEqual(output.dtype, expected_output.dtype)
+            np.testing.assert_array_equal(output, expected_output)
+            np.testing.assert_array_equal(chunk_output, expected_output[:1234])
+
+class TestDataProfiler(TestCase):
+    def test_profile_matches_the_data_and_reports_drift(self):
+        df = make_raw_frame(900, seed=10)
+        sources = [df.iloc[:300].copy(), df.iloc[300:600].copy(), df.iloc[600:].copy()]
+        sources[1]["diameter"] = np.nan
+        sources[2].loc[sources[2].index[:5], "sex"] = "X"
+        profiler = DataProfiler()
+        for index, source in enumerate(sources):
+            profiler.update({"bucketName": "data", "objectKey": f"{index}.csv"}, source)
+        profile = json.loads(json.dumps(profiler.profile()))
+        data = pd.concat(sources)
+
+        self.assertEqual(profile["rows"], 900)
+        self.assertEqual(list(profile["columns"]), feature_columns_names + [label_column])
+        for column in ("length", "diameter", label_column):
+            column_profile = profile["columns"][column]
+            values = data[column].dropna()
+            self.assertEqual(column_profile["nulls"], data[column].isna().sum())
+            self.assertEqual(column_profile["min"], values.min())
+            self.assertEqual(column_profile["max"], values.max())
+            self.assertAlmostEqual(column_profile["std"], values.std(ddof=0))
+            self.assertAlmostEqual(column_profile["quantiles"]["0.25"], values.quantile(0.25))
+            self.assertEqual(sum(column_profile["histogram"]["counts"]), len(values))
+        self.assertEqual(
+            profile["columns"]["sex"]["counts"], data["sex"].value_counts().to_dict()
+        )
+        self.assertEqual(profile["drift"], [
+            {"source": "data/1.csv", "column": "diameter", "issue": "all_null"},
+            {
+                "source": "data/2.csv",
+                "column": "sex",
+                "issue": "new_categories",
+                "categories": ["X"],
+            },
+        ])
+
+        data_processor = DataProcessor.from_statistics(profiler.statistics, sources[0])
+        sample = data.drop(columns=[label_column])
+        np.testing.assert_allclose(
+            data_processor._preprocess.transform(sample),
+            DataProcessor(data.copy())._preprocess.transform(sample),
+        )
+
+def make_raw_frame(rows, seed=0):
+    """Random raw abalone-like data with some missing values."""
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        np.round(rng.random((rows, len(feature_columns_names) + 1)), 3),
+        columns=feature_columns_names + [label_column],
+    )
+    df.loc[rng.random(rows) < 0.05, "height"] = np.nan
+    sex = pd.Series(rng.choice(["M", "F", "I"], rows), dtype=object)
+    df["sex"] = sex.where(rng.random(rows) >= 0.05, np.nan)
+    return df
+
+class FakeS3Client:
+    """In-memory stand-in for the subset of the boto3 S3 client used by DataBuilder and compact."""
+
+    def __init__(self, objects, delay=0):
+        self.objects = objects
+        self.delay = delay
+        self.requested = []
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter=None, ContinuationToken=None):
+        keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        listing, common_prefixes = [], []
+        for key in keys:
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common_prefix = key[:key.index(Delimiter, len(Prefix)) + 1]
+                if common_prefix not in common_prefixes:
+                    common_prefixes.append(common_prefix)
+            else:
+                listing.append(key)
+        start = int(ContinuationToken or 0)
+        page = listing[start:start + 2]
+        response = {
+            "Contents": [
+                {"Key": key, "ETag": '"etag"', "Size": len(self.objects[(Bucket, key)])}
+                for key in page
+            ],
+            "CommonPrefixes": [{"Prefix": prefix} for prefix in common_prefixes if not start],
+            "IsTruncated": start + 2 < len(listing),
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + 2)
+        return response
+
+    def head_object(self, Bucket, Key):
+        return {"ETag": '"%s"' % hashlib.md5(self.objects[(Bucket, Key)]).hexdigest()}
+
+    def upload_file(self, Filename, Bucket, Key):
+        with open(Filename, "rb") as f:
+            self.objects[(Bucket, Key)] = f.read()
+
+    def delete_objects(self, Bucket, Delete):
+        for item in Delete["Objects"]:
+            self.objects.pop((Bucket, item["Key"]), None)
+        return {}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None):
+        if IfMatch is not None and IfMatch != self.head_object(Bucket, Key)["ETag"]:
+            raise ClientError({"Error": {"Code": "PreconditionFailed"}}, "PutObject")
+        self.objects[(Bucket, Key)] = Body
+        return {"ETag": '"%s"' % hashlib.md5(Body).hexdigest()}
+
+    def get_object(self, Bucket, Key, Range=None):
+        self.requested.append(Key)
+        if self.delay:
+            time.sleep(random.random() * self.delay)
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey"}}, "GetObject")
+        data = self.objects[(Bucket, Key)]
+        if Range is None:
+            return {"Body": io.BytesIO(data), "ETag": self.head_object(Bucket, Key)["ETag"]}
+        start, end = (int(bound) for bound in Range[len("bytes="):].split("-"))
+        end = min(end, len(data) - 1)
+        return {
+            "Body": io.BytesIO(data[start:end + 1]),
+            "ContentRange": f"bytes {start}-{end}/{len(data)}",
+        }
+
+def make_manifest(keys, bucket="data"):
+    return json.dumps({"data": [{"bucketName": bucket, "objectKey": key} for key in keys]})
+
+class TestDataBuilder(TestCase):
+    def test_concurrent_build_keeps_manifest_order(self):
+        objects = {
+            ("data", f"{index}.csv"): f"M,{index},0.3,1,0.3,2,1,0,{index}\n".encode()
+            for index in range(20)
+        }
+        manifest = make_manifest([f"{index}.csv" for index in range(20)])
+
+        df = DataBuilder(
+            "/tmp", manifest, concurrency=4, s3_client=FakeS3Client(objects, delay=0.01)
+        ).build()
+
+        self.assertEqual(df["rings"].tolist(), list(range(20)))
+        self.assertEqual(df["length"].dtype, np.float64)
+
+    def test_ranged_download_matches_single_stream(self):
+        rng = np.random.default_rng(0)
+        lines = [
+            ",".join(
+                [["M", "F", "I", ""][index % 4]]
+                + [f"{value:.4f}" for value in rng.random(7)]
+                + [str(index % 29)]
+            )
+            for index in range(500)
+        ]
+        objects = {("data", "big.csv"): ("\n".join(lines) + "\n").encode()}
+        manifest = make_manifest(["big.csv"])
+
+        expected = DataBuilder("/tmp", manifest, s3_client=FakeS3Client(objects)).build()
+        actual = DataBuilder(
+            "/tmp", manifest, multipart_threshold=997, s3_client=FakeS3Client(objects)
+        ).build()
+
+        pd.testing.assert_frame_equal(actual, expected)
+
+    def test_compressed_and_columnar_formats_match_csv(self):
+        csv = (
+            b"M,0.455,0.365,0.095,0.514,0.2245,0.101,0.15,15\n"
+            b",0.35,0.265,0.09,0.2255,0.0995,0.0485,0.07,7\n"
+        )
+        manifest = make_manifest(["plain.csv"])
+        expected = DataBuilder("/tmp", manifest, s3_client=FakeS3Client({("data", "plain.csv"): csv})).build()
+
+        columnar = expected.assign(extra=1.0)
+        parquet, arrow = io.BytesIO(), io.BytesIO()
+        columnar.to_parquet(parquet)
+        columnar.reset_index(drop=True).to_feather(arrow)
+        objects = {
+            ("data", "gzip.csv.gz"): gzip.compress(csv),
+            ("data", "columnar.parquet"): parquet.getvalue(),
+            ("data", "columnar.arrow"): arrow.getvalue(),
+            ("data", "parquet-without-suffix"): parquet.getvalue(),
+        }
+        manifest = json.dumps({"data": [
+            {"bucketName": "data", "objectKey": "gzip.csv.gz"},
+            {"bucketName": "data", "objectKey": "columnar.parquet"},
+            {"bucketName": "data", "objectKey": "columnar.arrow"},
+            {"bucketName": "data", "objectKey": "parquet-without-suffix", "format": "parquet"},
+        ]})
+
+        for multipart_threshold in (None, 64):
+            df = DataBuilder(
+                "/tmp",
+                manifest,
+                multipart_threshold=multipart_threshold,
+                s3_client=FakeS3Client(objects),
+            ).build()
+            pd.testing.assert_frame_equal(
+                df.reset_index(drop=True),
+                pd.concat([expected] * 4, ignore_index=True),
+            )
+
+    def test_cache_only_fetches_changed_objects(self):
+        objects = {
+            ("data", f"{index}.csv"): f"F,{index},0.3,1,0.3,2,1,0,{index}\n".encode()
+            for index in range(3)
+        }
+        manifest = make_manifest([f"{index}.csv" for index in range(3)])
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = DataBuilder(
+                "/tmp", manifest, cache=IngestCache(cache_dir), s3_client=FakeS3Client(objects)
+            ).build()
+
+            objects[("data", "1.csv")] = b",9,0.3,1,0.3,2,1,0,9\n"
+            cache = IngestCache(cache_dir)
+            s3_client = FakeS3Client(objects)
+            second = DataBuilder("/tmp", manifest, cache=cache, s3_client=s3_client).build()
+
+            self.assertEqual((cache.hits, cache.misses), (2, 1))
+            self.assertEqual(s3_client.requested, ["1.csv"])
+            pd.testing.assert_frame_equal(second.iloc[[0, 2]], first.iloc[[0, 2]])
+            self.assertTrue(second["sex"].isna().iloc[1])
+
+            cache = IngestCache(cache_dir, max_bytes=1)
+            DataBuilder("/tmp", manifest, cache=cache, s3_client=FakeS3Client(objects)).build()
+            self.assertEqual(len(os.listdir(cache_dir)), 0)
+
+    def test_low_memory_mode_matches_default_mode(self):
+        df = make_raw_frame(300, seed=6)
+        df.loc[:149, "sex"] = "M"
+        objects = make_objects(df, 2)
+        manifest = make_manifest(["0.csv", "1.csv"])
+
+        expected = DataProcessor(
+            DataBuilder("/tmp", manifest, s3_client=FakeS3Client(objects)).build()
+        ).process()
+        low_memory_df = DataBuilder(
+            "/tmp", manifest, s3_client=FakeS3Client(objects), low_memory=True
+        ).build()
+        self.assertIsInstance(low_memory_df["sex"].dtype, pd.CategoricalDtype)
+        self.assertEqual(low_memory_df["length"].dtype, np.float32)
+
+        output = DataProcessor(low_memory_df, low_memory=True).process()
+        self.assertEqual(output.dtype, np.float32)
+        np.testing.assert_allclose(output, expected, atol=1e-5)
+
+    def test_manifest_file_with_prefix_entries(self):
+        keys = ["raw/a.csv", "raw/b.csv", "raw/c.csv", "raw/2021/d.csv", "raw/2022/e.csv",
+                "raw/2022/f.csv", "raw/2022/g.csv", "other/h.csv", "raw/2021.csv"]
+        objects = {
+            ("data", key): f"I,{index},0.3,1,0.3,2,1,0,{index}\n".encode()
+            for index, key in enumerate(keys)
+        }
+        manifest = {"version": 1, "data": [
+            {"bucketName": "data", "objectKey": "other/h.csv"},
+            {"bucketName": "data", "prefix": "raw/"},
+        ]}
+
+        with tempfile.TemporaryDirectory() as manifest_dir:
+            manifest_file = os.path.join(manifest_dir, "dataManifest.json")
+            with open(manifest_file, "w") as f:
+                json.dump(manifest, f)
+
+            df = DataBuilder(
+                "/tmp",
+                data_manifest_file=manifest_file,
+                concurrency=3,
+                s3_client=FakeS3Client(objects),
+            ).build()
+
+        # The objects under the prefix come in key order, whatever their depth.
+        self.assertEqual(df["rings"].tolist(), [7, 8, 3, 4, 5, 6, 0, 1, 2])
+
+class TestManifest(TestCase):
+    def test_iter_manifest_entries_in_small_blocks(self):
+        manifest = {
+            "version": 12345,
+            "data": [{"bucketName": "data", "objectKey": f"{index}.csv", "size": 10 ** index}
+                     for index in range(10)],
+            "source": {"nested": [1, 2, {"data": []}]},
+        }
+        text = json.dumps(manifest, indent=1)
+
+        for block_size in (1, 3, 7, 1 << 16):
+            entries = list(iter_manifest_entries(io.StringIO(text), block_size=block_size))
+            self.assertEqual(entries, manifest["data"])
+
+        json_lines = "\n".join(json.dumps(entry) for entry in manifest["data"]) + "\n"
+        entries = list(iter_manifest_entries(io.StringIO(json_lines), json_lines=True))
+        self.assertEqual(entries, manifest["data"])
+
+class TestChunkedProcessing(TestCase):
+    def test_incremental_refit_reuses_source_statistics(self):
+        df = make_raw_frame(600, seed=4)
+        objects = make_objects(df, 3)
+
+        _, saved, _ = run_chunked(objects, ["0.csv", "1.csv"])
+        saved = load_source_statistics(dump_source_statistics(saved))
+
+        incremental, source_statistics, _ = run_chunked(
+            objects, ["0.csv", "1.csv", "2.csv"], previous_source_statistics=saved
+        )
+        full, _, _ = run_chunked(objects, ["0.csv", "1.csv", "2.csv"])
+
+        self.assertEqual(len(source_statistics), 3)
+        for key, statistics in saved.items():
+            self.assertIs(source_statistics[key], statistics)
+        sample = df.drop(columns=[label_column])
+        np.testing.assert_allclose(
+            incremental._preprocess.transform(sample), full._preprocess.transform(sample)
+        )
+
+    def test_hash_split_is_stable_across_runs(self):
+        df = make_raw_frame(600, seed=5)
+        df[label_column] = np.arange(600, dtype=np.float64)
+        objects = make_objects(df, 3)
+
+        def splits(keys, **kwargs):
+            return run_chunked(objects, keys, splitter=DatasetSplitter("hash", seed=7), **kwargs)[2]
+
+        first = splits(["0.csv", "1.csv"], shuffle_buckets=3)
+        rerun = splits(["0.csv", "1.csv"], shuffle_buckets=3)
+        grown = splits(["0.csv", "1.csv", "2.csv"])
+
+        self.assertEqual(sum(len(split) for split in first), 400)
+        self.assertGreater(len(first[0]), 2 * len(first[1]))
+        for split, rerun_split, grown_split in zip(first, rerun, grown):
+            pd.testing.assert_frame_equal(split, rerun_split)
+            # Rows already split keep their split when more data arrives.
+            self.assertEqual(set(split[0]), set(grown_split[0]) & set(range(400)))
+
+    def test_checkpointed_run_resumes_after_the_last_completed_stage(self):
+        df = make_raw_frame(600, seed=6)
+        df[label_column] = np.arange(600, dtype=np.float64)
+        objects = make_objects(df, 3)
+        keys = ["0.csv", "1.csv", "2.csv"]
+
+        class FailingSplitter(DatasetSplitter):
+            def split(self, data_output, raw=None):
+                raise RuntimeError("split failed")
+
+        _, _, expected = run_chunked(objects, keys, splitter=DatasetSplitter("hash", seed=7))
+        with tempfile.TemporaryDirectory() as checkpoint_dir:
+            checkpoint = Checkpoint(checkpoint_dir, "run")
+            with self.assertRaises(RuntimeError):
+                run_chunked(
+                    objects, keys, splitter=FailingSplitter("hash", seed=7), checkpoint=checkpoint
+                )
+            self.assertEqual(
+                [checkpoint.done(stage) for stage in ("ingest", "fit", "transform", "split")],
+                [True, True, True, False],
+            )
+
+            # Had the ingested data been read again, the changed labels would show.
+            changed = make_raw_frame(600, seed=6)
+            changed[label_column] = np.arange(1000, 1600, dtype=np.float64)
+            _, source_statistics, splits = run_chunked(
+                make_objects(changed, 3),
+                keys,
+                splitter=DatasetSplitter("hash", seed=7),
+                checkpoint=checkpoint,
+            )
+            self.assertTrue(checkpoint.done("split"))
+            # A completed run only restores its outputs.
+            _, _, restored = run_chunked(
+                make_objects(changed, 3), keys, splitter=FailingSplitter(), checkpoint=checkpoint
+            )
+
+        self.assertEqual(len(source_statistics), 3)
+        for split, restored_split, expected_split in zip(splits, restored, expected):
+            pd.testing.assert_frame_equal(split, expected_split)
+            pd.testing.assert_frame_equal(restored_split, expected_split)
+
+    def test_run_resumes_after_the_model_failed_to_save(self):
+        df = make_raw_frame(600, seed=8)
+        objects = make_objects(df, 3)
+        keys = ["0.csv", "1.csv", "2.csv"]
+        with tempfile.TemporaryDirectory() as work_dir:
+            base_dir = os.path.join(work_dir, "processing")
+            for name in ("train", "validation", "test", "model"):
+                os.makedirs(os.path.join(base_dir, name))
+            manifest_file = os.path.join(work_dir, "manifest.json")
+            with open(manifest_file, "w") as f:
+                json.dump({"data": [
+                    {
+                        "bucketName": "data",
+                        "objectKey": key,
+                        "eTag": hashlib.md5(objects[("data", key)]).hexdigest(),
+                    }
+                    for key in keys
+                ]}, f)
+            saved = {
+                name: os.path.join(work_dir, name)
+                for name in ("statistics.json", "dedup.npz", "checkpoints")
+            }
+            argv = [
+                "preprocess.py",
+                "--data-manifest-file", manifest_file,
+                "--base-dir", base_dir,
+                "--chunked",
+                "--split-mode", "hash",
+                "--statistics-uri", saved["statistics.json"],
+                "--dedup-index", saved["dedup.npz"],
+                "--checkpoint-uri", saved["checkpoints"],
+            ]
+            save_model = DataProcessor.save_model
+
+            def fail_model_save(data_processor, model_path):
+                # The fit stage also saves the model, to its own directory.
+                if model_path == os.path.join(base_dir, "model"):
+                    raise RuntimeError("save failed")
+                save_model(data_processor, model_path)
+
+            # run_main adds a handler to the root logger on every run.
+            root_logger = logging.getLogger()
+            self.addCleanup(setattr, root_logger, "handlers", root_logger.handlers[:])
+            with mock.patch("sys.argv", argv), mock.patch(
+                "preprocess.boto3.client", return_value=FakeS3Client(objects)
+            ):
+                with mock.patch.object(
+                    DataProcessor, "save_model", autospec=True, side_effect=fail_model_save
+                ):
+                    with self.assertRaises(RuntimeError):
+                        run_main()
+                self.assertFalse(os.path.exists(saved["statistics.json"]))
+                self.assertFalse(os.path.exists(saved["dedup.npz"]))
+
+                # Every stage before the model is restored rather than run again.
+                with mock.patch.object(
+                    DataBuilder, "iter_sources", side_effect=RuntimeError("ingested again")
+                ), mock.patch.object(
+                    DataProcessor, "save_model", autospec=True, side_effect=save_model
+                ) as saved_model:
+                    run_main()
+
+            saved_model.assert_called_once_with(mock.ANY, os.path.join(base_dir, "model"))
+            self.assertEqual(os.listdir(saved["checkpoints"]), [])
+            self.assertTrue(os.path.exists(os.path.join(base_dir, "model", "model.tar.gz")))
+            with open(saved["statistics.json"]) as f:
+                self.assertEqual(len(json.load(f)["sources"]), 3)
+            with np.load(saved["dedup.npz"]) as index:
+                self.assertEqual(len(index["names"]), 3)
+
+    def test_checkpoint_is_cleared_under_its_fingerprint_only(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            stage_dir = os.path.join(work_dir, "stage")
+            os.makedirs(os.path.join(stage_dir, "part"))
+            for name in ("a", os.path.join("part", "b")):
+                with open(os.path.join(stage_dir, name), "wb") as f:
+                    f.write(name.encode())
+            s3 = FakeS3Client({})
+            for uri in (os.path.join(work_dir, "checkpoints"), "s3://checkpoints/prefix"):
+                kept = Checkpoint(uri, "run-2", s3_client=s3)
+                kept.save("fit", {"stage": stage_dir})
+                checkpoint = Checkpoint(uri, "run-1", s3_client=s3)
+                for stage in ("ingest", "fit", "transform"):
+                    checkpoint.save(stage, {"stage": stage_dir})
+                checkpoint.clear()
+                self.assertFalse(checkpoint.done("ingest"))
+                self.assertTrue(kept.done("fit"))
+            self.assertEqual(os.listdir(os.path.join(work_dir, "checkpoints")), ["run-2"])
+            self.assertTrue(all(key.startswith("prefix/run-2/") for _, key in s3.objects))
+
+class TestStageProfiler(TestCase):
+    def test_stages_record_time_and_memory(self):
+        profiler = StageProfiler()
+        with profiler.stage("ignored"):
+            pass
+        profiler.start(cprofile=True)
+        with profiler.stage("outer"):
+            for _ in range(2):
+                with profiler.stage("inner"):
+                    block = np.ones(1 << 20)
+                    del block
+
+            def download(_):
+                with profiler.stage("download"):
+                    time.sleep(0.01)
+
+            with ThreadPoolExecutor(2) as executor:
+                list(executor.map(download, range(4)))
+
+        with tempfile.TemporaryDirectory() as profile_dir:
+            profiler.write(os.path.join(profile_dir, "profile.json"))
+            with open(os.path.join(profile_dir, "profile.json")) as f:
+                stages = json.load(f)["stages"]
+            self.assertTrue(os.path.getsize(os.path.join(profile_dir, "profile.prof")))
+
+        self.assertEqual(set(stages), {"outer", "inner", "download"})
+        self.assertEqual(stages["inner"]["calls"], 2)
+        self.assertGreaterEqual(stages["inner"]["traced_peak_bytes"], 8 << 20)
+        # A nested stage's peak counts towards the outer one.
+        self.assertGreaterEqual(
+            stages["outer"]["traced_peak_bytes"], stages["inner"]["traced_peak_bytes"]
+        )
+        self.assertEqual(stages["download"]["calls"], 4)
+        self.assertTrue(stages["download"]["threaded"])
+        self.assertGreaterEqual(stages["download"]["wall_seconds"], 0.04)
+        self.assertNotIn("traced_peak_bytes", stages["download"])
+
+class TestDedupIndex(TestCase):
+    def test_rows_of_other_manifest_sources_are_dropped_across_runs(self):
+        df = make_raw_frame(300, seed=11)
+        df[label_column] = np.arange(300, dtype=np.float64)
+        objects = {
+            ("data", "a.csv"): df.iloc[:200].to_csv(header=False, index=False).encode(),
+            ("data", "b.csv"): df.iloc[150:].to_csv(header=False, index=False).encode(),
+        }
+
+        def build(keys, index_path, low_memory=False):
+            dedup = DedupIndex(index_path)
+            builder = DataBuilder(
+                "/tmp",
+                make_manifest(keys),
+                s3_client=FakeS3Client(objects),
+                dedup=dedup,
+                low_memory=low_memory,
+            )
+            labels = {
+                value["objectKey"]: sorted(chunk[label_column].astype(int))
+                for value, chunk in builder.iter_sources()
+            }
+            dedup.save()
+            return labels, dedup.dropped
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            index_path = os.path.join(index_dir, "index.npz")
+            labels, dropped = build(["a.csv", "b.csv"], index_path)
+            self.assertEqual(labels, {"a.csv": list(range(200)), "b.csv": list(range(200, 300))})
+            self.assertEqual(dropped, {"data/b.csv": 50})
+
+            # Sources ingested again keep their own rows, whatever the order.
+            labels, dropped = build(["b.csv", "a.csv"], index_path, low_memory=True)
+            self.assertEqual(labels, {"a.csv": list(range(200)), "b.csv": list(range(200, 300))})
+            self.assertEqual(dropped, {"data/b.csv": 50})
+
+            # Once a.csv leaves the manifest, b.csv owns the rows they share.
+            labels, dropped = build(["b.csv"], index_path)
+            self.assertEqual(labels, {"b.csv": list(range(150, 300))})
+            self.assertEqual(dropped, {})
+            self.assertEqual(build(["a.csv", "b.csv"], index_path)[1], {"data/a.csv": 50})
+
+    def test_empty_chunks_are_fitted_around_and_transformed(self):
+        df = make_raw_frame(400, seed=17)
+        df[label_column] = np.arange(400, dtype=np.float64)
+
+        class EmptyFirstBuilder(DataBuilder):
+            def iter_sources(self):
+                _, chunk = next(super().iter_sources())
+                yield {"bucketName": "data", "objectKey": "empty.csv"}, chunk.iloc[:0]
+                yield from super().iter_sources()
+
+        data_processor, _, splits = run_chunked(
+            make_objects(df, 2), ["0.csv", "1.csv"], builder_class=EmptyFirstBuilder
+        )
+
+        self.assertEqual(sorted(pd.concat(splits)[0]), list(range(400)))
+        output = data_processor.process_chunk(df.iloc[:0].copy())
+        self.assertEqual(output.shape, (0, 12))
+
+    def test_fully_duplicated_source_is_skipped_in_chunked_mode(self):
+        df = make_raw_frame(400, seed=15)
+        df[label_column] = np.arange(400, dtype=np.float64)
+        objects = make_objects(df, 2)
+        # A re-uploaded copy of 0.csv.
+        objects[("data", "copy.csv")] = objects[("data", "0.csv")]
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            dedup = DedupIndex(os.path.join(index_dir, "index.npz"))
+            _, _, splits = run_chunked(objects, ["0.csv", "copy.csv", "1.csv"], dedup=dedup)
+
+        self.assertEqual(list(dedup.dropped.values()), [200])
+        self.assertEqual(sorted(pd.concat(splits)[0]), list(range(400)))
+
+    def test_statistics_of_sources_with_dropped_rows_are_not_reused(self):
+        df = make_raw_frame(300, seed=16)
+        objects = {
+            ("data", "a.csv"): df.iloc[:200].to_csv(header=False, index=False).encode(),
+            ("data", "b.csv"): df.iloc[150:].to_csv(header=False, index=False).encode(),
+        }
+        sample = df.drop(columns=[label_column])
+
+        with tempfile.TemporaryDirectory() as index_dir:
+            index_path = os.path.join(index_dir, "index.npz")
+            dedup = DedupIndex(index_path)
+            _, saved, _ = run_chunked(objects, ["a.csv", "b.csv"], dedup=dedup)
+            dedup.save()
+            self.assertEqual([key.split("@")[0] for key in saved], ["data/a.csv"])
+
+            # Once a.csv leaves the manifest, all rows of b.csv are fitted.
+            incremental, source_statistics, _ = run_chunked(
+                objects, ["b.csv"], dedup=DedupIndex(index_path), previous_source_statistics=saved
+            )
+        full, _, _ = run_chunked(objects, ["b.csv"])
+
+        (statistics,) = source_statistics.values()
+        self.assertEqual(statistics.rows, 150)
+        np.testing.assert_allclose(
+            incremental._preprocess.transform(sample), full._preprocess.transform(sample)
+        )
+
+class TestRowSampler(TestCase):
+    def setUp(self):
+        df = make_raw_frame(900, seed=12)
+        df[label_column] = np.arange(900, dtype=np.float64)
+        self.objects = make_objects(df, 3)
+        self.keys = ["0.csv", "1.csv", "2.csv"]
+
+    def sample(self, sampler, **kwargs):
+        builder = DataBuilder(
+            "/tmp",
+            make_manifest(self.keys),
+            s3_client=FakeS3Client(self.objects),
+            sampler=sampler,
+            **kwargs,
+        )
+        return {value["objectKey"]: df for value, df in builder.iter_sources()}
+
+    def test_fraction_is_reproducible_bernoulli_sample(self):
+        first = self.sample(RowSampler(fraction=0.3, seed=1))
+        again = self.sample(RowSampler(fraction=0.3, seed=1), concurrency=3)
+        other = self.sample(RowSampler(fraction=0.3, seed=2))
+
+        self.assertEqual(list(first), self.keys)
+        rows = sum(len(df) for df in first.values())
+        self.assertTrue(200 < rows < 340)
+        for key in self.keys:
+            pd.testing.assert_frame_equal(first[key], again[key])
+        self.assertNotEqual(set(first["0.csv"][label_column]), set(other["0.csv"][label_column]))
+
+    def test_count_keeps_rows_of_lowest_priority(self):
+        sampler = RowSampler(count=50, seed=3)
+        sampled = self.sample(sampler, concurrency=3)
+
+        priorities = np.concatenate([
+            sampler._priorities(f"data/{key}", 0, 0)[:300] for key in self.keys
+        ])
+        expected = np.sort(np.argsort(priorities, kind="stable")[:50]).astype(np.float64)
+        labels = np.concatenate([df[label_column].to_numpy() for df in sampled.values()])
+        np.testing.assert_array_equal(labels, expected)
+        self.assertNotIn(RowSampler.priority_column, sampled["0.csv"])
+
+    def test_stratified_count_keeps_the_rings_distribution(self):
+        labels = np.repeat([5.0, 9.0, 12.0], [450, 270, 180])
+        df = make_raw_frame(900, seed=13)
+        df[label_column] = np.random.default_rng(14).permutation(labels)
+        self.objects = make_objects(df, 3)
+
+        sampled = self.sample(RowSampler(count=60, seed=4, stratify=True))
+        counts = pd.concat(sampled.values())[label_column].value_counts()
+        self.assertEqual(counts.to_dict(), {5.0: 30, 9.0: 18, 12.0: 12})
+
+    def test_objects_are_sampled_a_block_at_a_time(self):
+        sampler = RowSampler(fraction=0.5, seed=6)
+        sampler.block_rows = 64
+        sampled = self.sample(sampler)
+
+        for key in self.keys:
+            expected = sampler.select(
+                f"data/{key}", 0, pd.read_csv(io.BytesIO(self.objects[("data", key)]), header=None)
+            )
+            np.testing.assert_array_equal(
+                sampled[key][label_column].to_numpy(), expected.iloc[:, -1].to_numpy()
+            )
+            np.testing.assert_array_equal(sampled[key].index, expected.index)
+
+    def test_count_is_split_across_hosts(self):
+        keys = [f"{index}.csv" for index in range(7)]
+        objects = make_objects(make_raw_frame(700, seed=19), 7)
+        rows = []
+        for rank in range(3):
+            builder = DataBuilder(
+                "/tmp",
+                make_manifest(keys),
+                s3_client=FakeS3Client(objects),
+                rank=rank,
+                hosts=3,
+                sampler=RowSampler(count=host_share(50, rank, 3), seed=5),
+            )
+            rows.append(sum(len(chunk) for _, chunk in builder.iter_sources()))
+        self.assertEqual(rows, [17, 17, 16])
+
+    def test_objects_without_sampled_rows_are_skipped_in_chunked_mode(self):
+        df = make_raw_frame(303, seed=18)
+        objects = make_objects(df.iloc[3:], 3)
+        objects[("data", "small.csv")] = df.iloc[:3].to_csv(header=False, index=False).encode()
+        keys = ["small.csv", "0.csv", "1.csv", "2.csv"]
+
+        for seed in (0, 4):
+            sampler = RowSampler(fraction=0.1, seed=seed)
+            sampled = {
+                value["objectKey"]: len(chunk)
+                for value, chunk in DataBuilder(
+                    "/tmp", make_manifest(keys), s3_client=FakeS3Client(objects), sampler=sampler
+                ).iter_sources()
+            }
+            self.assertNotIn("small.csv", sampled)
+            _, _, splits = run_chunked(objects, keys, sampler=RowSampler(fraction=0.1, seed=seed))
+            self.assertEqual(sum(map(len, splits)), sum(sampled.values()))
+
+
+    def test_hosts_fit_one_model_and_write_disjoint_parts(self):
+        df = make_raw_frame(900, seed=8)
+        df[label_column] = np.arange(900, dtype=np.float64)
+        objects = make_objects(df, 7)
+        keys = [f"{index}.csv" for index in range(7)]
+        sample = df.drop(columns=[label_column])
+
+        with tempfile.TemporaryDirectory() as rendezvous_dir:
+            with multiprocessing.get_context("fork").Pool(3) as pool:
+                results = pool.starmap(
+                    run_host, [(objects, keys, rendezvous_dir, rank, 3) for rank in range(3)]
+                )
+        single_host, _, single_host_splits = run_chunked(
+            objects, keys, splitter=DatasetSplitter("hash", seed=7)
+        )
+
+        expected_output = single_host._preprocess.transform(sample)
+        for name_index, single_host_split in enumerate(single_host_splits):
+            labels = [set(splits[name_index][0]) for _, splits, _ in results]
+            self.assertEqual(sum(map(len, labels)), len(single_host_split))
+            self.assertEqual(set.union(*labels), set(single_host_split[0]))
+        for preprocess, _, source_statistics in results:
+            self.assertEqual(len(source_statistics), 7)
+            np.testing.assert_allclose(preprocess.transform(sample), expected_output)
+
+    def test_hosts_that_completed_the_fit_still_publish_their_statistics(self):
+        df = make_raw_frame(600, seed=19)
+        objects = make_objects(df, 4)
+        keys = [f"{index}.csv" for index in range(4)]
+        sample = df.drop(columns=[label_column])
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            def run(execution, checkpoint_keys):
+                arguments = [
+                    (
+                        objects,
+                        keys,
+                        os.path.join(work_dir, execution),
+                        rank,
+                        2,
+                        Checkpoint(os.path.join(work_dir, "checkpoints"), checkpoint_key),
+                    )
+                    for rank, checkpoint_key in enumerate(checkpoint_keys)
+                ]
+                with multiprocessing.get_context("fork").Pool(2) as pool:
+                    return pool.starmap(run_host, arguments)
+
+            first = run("first", ["host-0", "host-1"])
+            # Host 0 completed every stage; host 1 starts over, under a new key.
+            second = run("second", ["host-0", "host-1-changed"])
+
+        for (preprocess, _, _), (expected, _, _) in zip(second, first):
+            np.testing.assert_allclose(preprocess.transform(sample), expected.transform(sample))
+
+def run_host(objects, keys, rendezvous_dir, rank, hosts, checkpoint=None):
+    """Runs one host of a distributed process_in_chunks over the fake data bucket."""
+    rendezvous = Rendezvous(rendezvous_dir, rank, hosts, timeout=60, poll_interval=0.05)
+    data_processor, source_statistics, splits = run_chunked(
+        objects,
+        keys,
+        splitter=DatasetSplitter("hash", seed=7),
+        rendezvous=rendezvous,
+        rank=rank,
+        hosts=hosts,
+        checkpoint=checkpoint,
+    )
+    return data_processor._preprocess, splits, source_statistics
+
+class TestSplitOutputs(TestCase):
+    def test_appended_rows_round_trip_in_every_format(self):
+        rows = np.random.default_rng(6).normal(size=(50, 11))
+        with tempfile.TemporaryDirectory() as base_dir:
+            outputs = {}
+            for output_format in ("csv", "parquet", "npy", "recordio"):
+                split_file = SplitFile(os.path.join(base_dir, output_format), output_format)
+                split_file.write(rows[:20])
+                split_file.write(rows[20:])
+                split_file.close()
+                with open(split_file.path, "rb") as f:
+                    outputs[output_format] = f.read()
+
+            np.testing.assert_allclose(
+                pd.read_csv(os.path.join(base_dir, "csv"), header=None).to_numpy(), rows
+            )
+            np.testing.assert_array_equal(
+                pd.read_parquet(os.path.join(base_dir, "parquet")).to_numpy(), rows
+            )
+            np.testing.assert_array_equal(
+                np.load(os.path.join(base_dir, "npy"), mmap_mode="r"), rows
+            )
+        np.testing.assert_array_equal(
+            read_recordio_protobuf(outputs["recordio"]), rows.astype(np.float32)
+        )
+
+    def test_shards_are_balanced_and_indexed(self):
+        rows = np.random.default_rng(9).normal(size=(103, 11))
+        with tempfile.TemporaryDirectory() as base_dir:
+            for name in ("train", "validation", "test"):
+                os.makedirs(os.path.join(base_dir, name))
+            writer = SplitWriter(base_dir, output_format="npy", part=1, shards=4)
+            for start in range(0, 103, 25):
+                writer.write("train", rows[start:start + 25])
+            writer.close()
+
+            with open(os.path.join(base_dir, "index", "train-00001.json")) as f:
+                index = json.load(f)
+            parts = [
+                np.load(os.path.join(base_dir, "train", part["file"])) for part in index["parts"]
+            ]
+            part_bytes = [
+                os.path.getsize(os.path.join(base_dir, "train", part["file"]))
+                for part in index["parts"]
+            ]
+
+        self.assertEqual(
+            [part["file"] for part in index["parts"]],
+            ["part-00004.npy", "part-00005.npy", "part-00006.npy", "part-00007.npy"],
+        )
+        self.assertEqual([part["rows"] for part in index["parts"]], [26, 26, 26, 25])
+        self.assertEqual([part["bytes"] for part in index["parts"]], part_bytes)
+        self.assertEqual((index["rows"], index["columns"]), (103, 11))
+        np.testing.assert_array_equal(
+            np.concatenate(parts)[np.argsort(np.concatenate(parts)[:, 0])],
+            rows[np.argsort(rows[:, 0])],
+        )
+
+def read_protobuf_fields(data):
+    """Yields the field number and payload of every length-delimited protobuf field."""
+    position = 0
+    while position < len(data):
+        values = []
+        for _ in range(2):
+            value, shift = 0, 0
+            while True:
+                byte = data[position]
+                position += 1
+                value |= (byte & 0x7F) << shift
+                shift += 7
+                if byte < 0x80:
+                    break
+            values.append(value)
+        key, size = values
+        assert key & 7 == 2
+        yield key >> 3, data[position:position + size]
+        position += size
+
+def read_recordio_protobuf(data):
+    """Decodes dense float32 RecordIO-protobuf records into rows, label first if any."""
+    rows = []
+    position = 0
+    while position < len(data):
+        magic, size = struct.unpack_from("<II", data, position)
+        assert magic == 0xCED7230A
+        record = data[position + 8:position + 8 + size]
+        position += 8 + size + -size % 4
+        values = {}
+        for field, entry in read_protobuf_fields(record):
+            (_, key), (_, value) = read_protobuf_fields(entry)
+            ((_, tensor),) = read_protobuf_fields(value)
+            ((_, packed),) = read_protobuf_fields(tensor)
+            assert key == b"values"
+            values["label" if field == 2 else "features"] = np.frombuffer(packed, dtype="<f4")
+        rows.append(np.concatenate([values.get("label", []), values["features"]]))
+    return np.array(rows)
+
+def make_objects(df, count):
+    """Splits df into count CSV objects of the fake data bucket."""
+    rows = len(df) // count
+    return {
+        ("data", f"{index}.csv"): df.iloc[index * rows:(index + 1) * rows]
+        .to_csv(header=False, index=False)
+        .encode()
+        for index in range(count)
+    }
+
+def run_chunked(objects, keys, **kwargs):
+    """Runs process_in_chunks over the given objects of the fake data bucket.
+
+    Returns the fitted processor, the per-source statistics and the written
+    train, validation and test datasets.
+    """
+    manifest = json.dumps({"data": [
+        {
+            "bucketName": "data",
+            "objectKey": key,
+            "eTag": hashlib.md5(objects[("data", key)]).hexdigest(),
+        }
+        for key in keys
+    ]})
+    with tempfile.TemporaryDirectory() as base_dir:
+        for name in ("train", "validation", "test"):
+            os.makedirs(os.path.join(base_dir, name))
+        rank, hosts = kwargs.pop("rank", 0), kwargs.pop("hosts", 1)
+        builder = kwargs.pop("builder_class", DataBuilder)(
+            base_dir,
+            manifest,
+            s3_client=FakeS3Client(objects),
+            rank=rank,
+            hosts=hosts,
+            dedup=kwargs.pop("dedup", None),
+            sampler=kwargs.pop("sampler", None),
+        )
+        data_processor, source_statistics = process_in_chunks(builder, base_dir, **kwargs)
+        splits = []
+        for name in ("train", "validation", "test"):
+            path = os.path.join(base_dir, name, os.listdir(os.path.join(base_dir, name))[0])
+            splits.append(
+                pd.read_csv(path, header=None) if os.path.getsize(path) else pd.DataFrame({0: []})
+            )
+    return data_processor, source_statistics, splits
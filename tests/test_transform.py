@@ -0,0 +1,191 @@
+# Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.                                                                              *
+
+from unittest import TestCase
+import io
+import json
+import mmap
+import os
+import tempfile
+import joblib
+import numpy as np
+import pandas as pd
+from preprocess import DataProcessor, FitStatistics, label_column
+from transform import (
+    CompiledPreprocessor,
+    encode_libsvm,
+    encode_recordio_protobuf,
+    fast_csv_max_rows,
+    input_fn,
+    model_fn,
+    parse_csv,
+    predict_fn,
+)
+from test_preprocess import make_raw_frame, read_recordio_protobuf
+
+def saved_models(data_processor):
+    """Returns the compiled and the joblib preprocessors saved by data_processor."""
+    with tempfile.TemporaryDirectory() as model_dir:
+        data_processor.save_model(model_dir)
+        return model_fn(model_dir), joblib.load(os.path.join(model_dir, "model.joblib"))
+
+class TestCompiledPreprocessor(TestCase):
+    def test_compiled_preprocessor_matches_the_pipeline(self):
+        df = make_raw_frame(500, seed=31)
+        statistics = FitStatistics()
+        statistics.update(df)
+        processors = [
+            DataProcessor(df.copy()),
+            DataProcessor.from_statistics(statistics, df.iloc[:10].copy()),
+        ]
+
+        requests = make_raw_frame(50, seed=32)
+        requests.loc[:4, "sex"] = "X"
+        requests.loc[5:9, "length"] = np.nan
+        labelled = requests.to_csv(header=False, index=False)
+        unlabelled = requests.drop(columns=[label_column]).to_csv(header=False, index=False)
+
+        for data_processor in processors:
+            compiled, pipeline = saved_models(data_processor)
+            self.assertIsInstance(compiled, CompiledPreprocessor)
+            for payload in (labelled, unlabelled):
+                input_data = input_fn(payload, "text/csv")
+                np.testing.assert_array_equal(
+                    predict_fn(input_data, compiled), predict_fn(input_data, pipeline)
+                )
+
+    def test_model_fn_maps_the_saved_arrays(self):
+        data_processor = DataProcessor(make_raw_frame(500, seed=39))
+        input_data = input_fn(make_raw_frame(20, seed=40).to_csv(header=False, index=False),
+                              "text/csv")
+        with tempfile.TemporaryDirectory() as model_dir:
+            data_processor.save_model(model_dir)
+            compiled = model_fn(model_dir)
+            base = compiled.medians
+            while isinstance(base, np.ndarray):
+                base = base.base
+            self.assertIsInstance(base, mmap.mmap)
+            expected = predict_fn(input_data, compiled)
+
+            # Models saved with model.joblib alone still load.
+            os.remove(os.path.join(model_dir, "compiled.npy"))
+            pipeline = model_fn(model_dir)
+            self.assertNotIsInstance(pipeline, CompiledPreprocessor)
+            np.testing.assert_array_equal(predict_fn(input_data, pipeline), expected)
+
+class TestParseCsv(TestCase):
+    def test_rows_parse_like_pandas(self):
+        requests = make_raw_frame(20, seed=33)
+        requests.loc[2, "sex"] = "NA"
+        for df in (requests, requests.drop(columns=[label_column])):
+            payload = df.to_csv(header=False, index=False)
+            data = parse_csv(payload)
+            self.assertEqual(list(data.dtype.names), list(df.columns))
+            pd.testing.assert_frame_equal(
+                pd.DataFrame(data), pd.read_csv(io.StringIO(payload), header=None, names=df.columns)
+            )
+
+    def test_malformed_rows_are_reported(self):
+        row = "M,0.455,0.365,0.095,0.514,0.2245,0.101,0.15"
+        with self.assertRaisesRegex(ValueError, "Row 2 has 7 fields"):
+            parse_csv(f"{row}\n{row.rsplit(',', 1)[0]}\n")
+        with self.assertRaisesRegex(ValueError, "Row 1: height 'tall' is not a number"):
+            parse_csv(row.replace("0.095", "tall"))
+        with self.assertRaisesRegex(ValueError, "Row 1 has 3 fields"):
+            parse_csv("M,0.455,0.365")
+
+        # Quoted fields are left to pandas.
+        self.assertIsNone(parse_csv(row.replace("M", '"M"')))
+        df = input_fn(row.replace("M", '"M"').encode(), "text/csv")
+        self.assertEqual(df["sex"].tolist(), ["M"])
+
+def encode_npy(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+class TestBatchPayloads(TestCase):
+    def test_batches_transform_alike_in_every_format(self):
+        compiled, pipeline = saved_models(DataProcessor(make_raw_frame(500, seed=34)))
+        requests = make_raw_frame(fast_csv_max_rows + 44, seed=35)
+        requests.loc[3, "sex"] = np.nan
+        requests.loc[7, "length"] = np.nan
+
+        for df in (requests, requests.drop(columns=[label_column])):
+            rows = df.astype(object).where(df.notna(), None).values.tolist()
+            payloads = {
+                "text/csv": df.to_csv(header=False, index=False),
+                "application/jsonlines": df.to_json(orient="records", lines=True),
+                "application/x-jsonlines": "\n".join(json.dumps(row) for row in rows),
+                "application/x-npy": encode_npy(
+                    np.rec.fromarrays(
+                        [df[name].fillna("").to_numpy(dtype=str) if name == "sex" else df[name]
+                         for name in df.columns],
+                        names=list(df.columns),
+                    )
+                ),
+            }
+            expected = predict_fn(input_fn(payloads["text/csv"], "text/csv"), pipeline)
+            self.assertEqual(expected.shape[0], len(df))
+            for content_type, payload in payloads.items():
+                for model in (compiled, pipeline):
+                    np.testing.assert_array_equal(
+                        predict_fn(input_fn(payload, content_type), model), expected
+                    )
+            # A two-dimensional array of the csv fields.
+            fields = encode_npy(df.astype(str).to_numpy().astype(str))
+            np.testing.assert_array_equal(
+                predict_fn(input_fn(fields, "application/x-npy"), compiled), expected
+            )
+
+    def test_mixed_batches_are_rejected(self):
+        df = make_raw_frame(fast_csv_max_rows + 4, seed=36)
+        lines = df.to_csv(header=False, index=False).splitlines()
+        lines[-1] = lines[-1].rsplit(",", 1)[0]
+        with self.assertRaisesRegex(ValueError, f"Row {len(lines)} has 8 fields, not 9"):
+            input_fn("\n".join(lines), "text/csv")
+
+        records = df.iloc[:3].to_dict(orient="records")
+        del records[1][label_column]
+        with self.assertRaisesRegex(ValueError, "Row 2 is unlabelled, unlike row 1"):
+            input_fn("\n".join(json.dumps(record) for record in records), "application/jsonlines")
+        del records[2]["sex"]
+        del records[2][label_column]
+        records[0] = records[1]
+        with self.assertRaisesRegex(ValueError, "Row 3 lacks sex"):
+            input_fn("\n".join(json.dumps(record) for record in records), "application/jsonlines")
+
+class TestResponseEncodings(TestCase):
+    def test_binary_responses_hold_the_features(self):
+        compiled, _ = saved_models(DataProcessor(make_raw_frame(500, seed=37)))
+        payload = make_raw_frame(30, seed=38).drop(columns=[label_column]).to_csv(
+            header=False, index=False
+        )
+        features = predict_fn(input_fn(payload, "text/csv"), compiled)
+
+        np.testing.assert_array_equal(
+            read_recordio_protobuf(encode_recordio_protobuf(features)),
+            features.astype(np.float32),
+        )
+        lines = encode_libsvm(features).splitlines()
+        self.assertEqual(len(lines), len(features))
+        for line, row in zip(lines, features.astype(np.float32)):
+            label, *entries = line.split(" ")
+            self.assertEqual(label, "0")
+            self.assertEqual([entry.split(":")[0] for entry in entries],
+                             [str(index) for index in range(len(row))])
+            np.testing.assert_array_equal(
+                np.array([entry.split(":")[1] for entry in entries], dtype=np.float32), row
+            )